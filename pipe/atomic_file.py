@@ -0,0 +1,21 @@
+import gzip
+import os
+
+
+def write_file_atomically(file_name, content, compress=False):
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+
+    # The content is written next to the file first and then renamed over it,
+    # so a reader, even of another pipe run, never sees a partly written file
+    temporary_file = f'{file_name}.{os.getpid()}.tmp'
+
+    try:
+        with (gzip.open(temporary_file, 'wt', encoding='utf-8') if compress else open(temporary_file, 'w')) as file:
+            file.write(content)
+
+        os.replace(temporary_file, file_name)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+        raise
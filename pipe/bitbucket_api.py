@@ -1,15 +1,41 @@
-from uuid import uuid4
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from itertools import islice
+from threading import Lock
 
+import requests
 from bitbucket_pipes_toolkit import CodeInsights, get_logger, get_variable
 
+from rate_limiter import DEFAULT_RATE_LIMIT, RateLimitedAdapter, RateLimiter, get_connection_stats
+from transport import create_transport_adapter
+
 logger = get_logger()
 
+# The maximum number of annotations accepted by one bulk upload request
+ANNOTATION_BATCH_SIZE = 100
+
+# The maximum number of annotation batches uploaded at the same time
+ANNOTATION_UPLOAD_WORKERS = 4
+
+# The maximum number of stale annotations deleted by one sync, every delete is
+# a request of its own, the rest is left for the next sync
+MAX_ANNOTATION_DELETES = 100
+
+RATE_LIMITER_NAME = 'Bitbucket'
+
 
 class BitbucketApi:
 
-    def get_or_create_report(self, commit):
-        logger.info("get_or_create_report")
+    def __init__(self, rate_limiter=None, transport=None):
+        self._insights = self._create_code_insights()
+        self._rate_limiter: RateLimiter = rate_limiter or RateLimiter(
+            RATE_LIMITER_NAME, float(get_variable('BITBUCKET_RATE_LIMIT', default=DEFAULT_RATE_LIMIT)))
+        self._session = self._create_session(transport)
+        self._reports_by_commit = {}
+        self._reports_lock = Lock()
 
+    def _create_code_insights(self):
         bitbucket_user = get_variable('BITBUCKET_USERNAME')
         bitbucket_repository = get_variable('BITBUCKET_REPOSITORY')
 
@@ -17,26 +43,72 @@ class BitbucketApi:
             logger.info(
                 f"Creating authenticated API client for repository: {bitbucket_repository} and user: {bitbucket_user}")
 
-            insights = CodeInsights(repo=bitbucket_repository,
-                                    username=bitbucket_user,
-                                    auth_type='basic',
-                                    app_password=get_variable('BITBUCKET_PASSWORD'))
-        else:
-            logger.info(
-                f"Creating unauthenticated API client for repository: {bitbucket_repository} and user: {bitbucket_user}")
+            return CodeInsights(repo=bitbucket_repository,
+                                username=bitbucket_user,
+                                auth_type='basic',
+                                app_password=get_variable('BITBUCKET_PASSWORD'))
 
-            insights = CodeInsights(repo=bitbucket_repository,
-                                    username=bitbucket_user)
+        logger.info(
+            f"Creating unauthenticated API client for repository: {bitbucket_repository} and user: {bitbucket_user}")
 
-        expected_external_id = f'openqualitychecker-warning-report-{commit}'
+        return CodeInsights(repo=bitbucket_repository,
+                            username=bitbucket_user)
+
+    def _create_session(self, transport=None):
+        adapter = RateLimitedAdapter(self._rate_limiter, logger,
+                                     transport=transport or create_transport_adapter(
+                                         pool_connections=ANNOTATION_UPLOAD_WORKERS,
+                                         pool_maxsize=ANNOTATION_UPLOAD_WORKERS),
+                                     pool_connections=ANNOTATION_UPLOAD_WORKERS,
+                                     pool_maxsize=ANNOTATION_UPLOAD_WORKERS)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.auth = self._insights.auth
+        session.proxies.update(self._insights._get_http_proxies())
+
+        return session
+
+    def _reports_url(self, commit):
+        return f'{self._insights.url_scheme}://api.bitbucket.org/2.0/repositories/' \
+               f'{self._insights.username}/{self._insights.repo_slug}/commit/{commit}/reports'
+
+    def get_connection_stats(self):
+        return get_connection_stats(self._session)
+
+    def close(self):
+        stats = self.get_connection_stats()
+        rate_limiter_stats = self._rate_limiter.get_stats()
+
+        logger.debug(
+            f"Bitbucket connections opened: {stats['connections']}, requests sent: {stats['requests']}, "
+            f"requests throttled: {rate_limiter_stats['throttled_requests']} "
+            f"for {rate_limiter_stats['throttled_time']:.1f} s, "
+            f"rate limited responses: {rate_limiter_stats['rate_limited_responses']}")
+
+        self._session.close()
+
+    def get_or_create_report(self, commit):
+        logger.info("get_or_create_report")
 
-        reports = insights.get_reports(commit)
+        with self._reports_lock:
+            report = self._reports_by_commit.get(commit)
 
-        logger.info(f"Existing reports: {reports}")
+            if report is None:
+                report = self._find_or_create_report(commit)
+                self._reports_by_commit[commit] = report
 
-        for report in reports['values']:
-            if report['external_id'] == expected_external_id:
-                return report
+        return report
+
+    def _find_or_create_report(self, commit):
+        expected_external_id = f'openqualitychecker-warning-report-{commit}'
+
+        report = self._find_report(commit, expected_external_id)
+
+        if report is not None:
+            logger.info(f"Found existing report: {report.get('uuid')}")
+            return report
 
         report_data = {
             "type": "report",
@@ -47,32 +119,184 @@ class BitbucketApi:
             "reporter": "OpenQualityChecker Pipe",
             "external_id": expected_external_id,
         }
-        report = insights.create_report(commit, report_data=report_data)
+
+        response = self._session.put(f'{self._reports_url(commit)}/{expected_external_id}', json=report_data)
+        response.raise_for_status()
+
+        report = response.json()
 
         logger.info(f"Created report: {report}")
 
         return report
 
-    def annotate(self, path, line_number, commit, report_id):
+    def _find_report(self, commit, external_id):
+        url = self._reports_url(commit)
+        scanned_reports = 0
+
+        while url:
+            response = self._session.get(url)
+            response.raise_for_status()
+
+            reports = response.json()
+
+            for report in reports.get('values', []):
+                if report.get('external_id') == external_id:
+                    return report
+
+                scanned_reports = scanned_reports + 1
+
+            url = reports.get('next')
+
+        logger.debug(f"Report {external_id} not found among {scanned_reports} existing reports")
+
+        return None
+
+    def annotate(self, path, line_number, commit, report_id, project=None, rule=None):
         logger.info("annotate")
 
-        bitbucket_user = get_variable('BITBUCKET_USERNAME')
-        bitbucket_repository = get_variable('BITBUCKET_REPOSITORY')
+        annotation_data = self._create_annotation_data({'path': path, 'line': line_number,
+                                                        'project': project, 'rule': rule})
 
-        insights = CodeInsights(repo=bitbucket_repository,
-                                username=bitbucket_user)
+        response = self._session.put(
+            f"{self._reports_url(commit)}/{report_id}/annotations/{annotation_data['external_id']}",
+            json=annotation_data)
+        response.raise_for_status()
 
-        annotation_data = {
-            "annotation_type": "VULNERABILITY",
-            "external_id": str(uuid4()),
-            "summary": get_variable('ANNOTATION_SUMMARY'),
-            "details": get_variable('ANNOTATION_DESCRIPTION'),
-            "severity": "HIGH",
-            "result": "FAILED",
-            "line": line_number,
-            "path": path
+        annotation = response.json()
+
+        logger.info(f"Created annotation: {annotation}")
+
+    def annotate_bulk(self, findings, commit, report_id):
+        logger.info("annotate_bulk")
+
+        return self._upload_annotations(map(self._create_annotation_data, findings), commit, report_id)
+
+    def sync_annotations(self, findings, commit, report_id):
+        logger.info("sync_annotations")
+
+        annotations = {annotation['external_id']: annotation
+                       for annotation in map(self._create_annotation_data, findings)}
+        existing_annotations = self.get_annotations(commit, report_id)
+
+        changed_annotations = [annotation for external_id, annotation in annotations.items()
+                               if not self._is_annotation_unchanged(annotation,
+                                                                    existing_annotations.get(external_id))]
+        stale_external_ids = [external_id for external_id in existing_annotations
+                              if external_id not in annotations]
+
+        logger.info(f"Annotations to upload: {len(changed_annotations)}, to delete: {len(stale_external_ids)}, "
+                    f"unchanged: {len(annotations) - len(changed_annotations)}")
+
+        if len(stale_external_ids) > MAX_ANNOTATION_DELETES:
+            logger.warning(f"Deleting only {MAX_ANNOTATION_DELETES} of {len(stale_external_ids)} stale annotations, "
+                           f"the rest is deleted by the next sync")
+
+            stale_external_ids = stale_external_ids[:MAX_ANNOTATION_DELETES]
+
+        batch_results = self._upload_annotations(iter(changed_annotations), commit, report_id)
+        delete_results = self._delete_annotations(stale_external_ids, commit, report_id)
+
+        return {
+            'uploaded': len(changed_annotations),
+            'deleted': len(stale_external_ids),
+            'unchanged': len(annotations) - len(changed_annotations),
+            'errors': [result['error'] for result in batch_results + delete_results if result['error']]
         }
 
-        annotation = insights.create_annotation(commit, report_id, annotation_data)
+    def get_annotations(self, commit, report_id):
+        url = f'{self._reports_url(commit)}/{report_id}/annotations'
+        annotations = {}
 
-        logger.info(f"Created annotation: {annotation}")
+        while url:
+            response = self._session.get(url)
+            response.raise_for_status()
+
+            response_body = response.json()
+
+            for annotation in response_body.get('values', []):
+                annotations[annotation.get('external_id')] = annotation
+
+            url = response_body.get('next')
+
+        logger.debug(f"Existing annotations in report {report_id}: {len(annotations)}")
+
+        return annotations
+
+    def _is_annotation_unchanged(self, annotation, existing_annotation):
+        if existing_annotation is None:
+            return False
+
+        return all(existing_annotation.get(key) == value for key, value in annotation.items())
+
+    def _upload_annotations(self, annotations, commit, report_id):
+        url = f'{self._reports_url(commit)}/{report_id}/annotations'
+
+        def upload_batch(batch_index, batch):
+            try:
+                response = self._session.post(url, json=batch)
+                response.raise_for_status()
+
+                logger.info(f"Created {len(batch)} annotations in batch {batch_index}")
+
+                return {'batch': batch_index, 'size': len(batch), 'annotations': response.json(),
+                        'error': None}
+            except Exception as error:
+                logger.error(f"Failed to create {len(batch)} annotations in batch {batch_index}: {error}")
+
+                return {'batch': batch_index, 'size': len(batch), 'annotations': None,
+                        'error': f'{error}'}
+
+        with ThreadPoolExecutor(max_workers=ANNOTATION_UPLOAD_WORKERS) as executor:
+            batch_results = [executor.submit(copy_context().run, upload_batch, batch_index, batch)
+                             for batch_index, batch in enumerate(self._batch_annotations(annotations))]
+
+            return [batch_result.result() for batch_result in batch_results]
+
+    def _delete_annotations(self, external_ids, commit, report_id):
+        url = f'{self._reports_url(commit)}/{report_id}/annotations'
+
+        def delete_annotation(external_id):
+            try:
+                response = self._session.delete(f'{url}/{external_id}')
+                response.raise_for_status()
+
+                logger.debug(f"Deleted stale annotation: {external_id}")
+
+                return {'external_id': external_id, 'error': None}
+            except Exception as error:
+                logger.error(f"Failed to delete stale annotation {external_id}: {error}")
+
+                return {'external_id': external_id, 'error': f'{error}'}
+
+        with ThreadPoolExecutor(max_workers=ANNOTATION_UPLOAD_WORKERS) as executor:
+            delete_results = [executor.submit(copy_context().run, delete_annotation, external_id)
+                              for external_id in external_ids]
+
+            return [delete_result.result() for delete_result in delete_results]
+
+    def _batch_annotations(self, annotations):
+        while True:
+            batch = list(islice(annotations, ANNOTATION_BATCH_SIZE))
+
+            if not batch:
+                return
+
+            yield batch
+
+    def _create_annotation_data(self, finding):
+        return {
+            "annotation_type": finding.get('annotation_type', "VULNERABILITY"),
+            "external_id": finding.get('external_id') or self._create_annotation_external_id(finding),
+            "summary": finding.get('summary') or get_variable('ANNOTATION_SUMMARY'),
+            "details": finding.get('details') or get_variable('ANNOTATION_DESCRIPTION'),
+            "severity": finding.get('severity', "HIGH"),
+            "result": finding.get('result', "FAILED"),
+            "line": finding['line'],
+            "path": finding['path']
+        }
+
+    def _create_annotation_external_id(self, finding):
+        identity = '|'.join('' if finding.get(key) is None else f'{finding[key]}'
+                            for key in ('project', 'path', 'line', 'rule'))
+
+        return f"openqualitychecker-{hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]}"
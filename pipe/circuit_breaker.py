@@ -0,0 +1,82 @@
+from threading import Lock
+
+from clock import get_clock
+
+# The number of consecutive connection level failures after which no more
+# requests are sent to a service
+DEFAULT_FAILURE_THRESHOLD = 5
+
+# The number of seconds an open circuit rejects requests before it lets one
+# trial request through, a success closes the circuit again
+DEFAULT_COOL_DOWN = 30
+
+# Responses telling that the service itself is not reachable rather than
+# that the requested data is not available yet
+UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+
+class ServiceUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, cool_down=DEFAULT_COOL_DOWN, clock=None):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._cool_down = cool_down
+        self._clock = clock or get_clock()
+        self._consecutive_failures = 0
+        self._last_error = None
+        self._opened_at = None
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def check(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            now = self._clock.monotonic()
+
+            if now - self._opened_at >= self._cool_down:
+                # Half open: this request is the trial, the others keep being
+                # rejected until it succeeds or another cool down passes
+                self._opened_at = now
+                return
+
+            error = self._create_error()
+
+        raise error
+
+    def record_success(self):
+        self.reset()
+
+    def record_failure(self, error):
+        with self._lock:
+            self._consecutive_failures = self._consecutive_failures + 1
+            self._last_error = error
+
+            tripped = self._consecutive_failures >= self._failure_threshold
+
+            if tripped:
+                self._opened_at = self._clock.monotonic()
+                unavailable_error = self._create_error()
+
+        if tripped:
+            raise unavailable_error from error
+
+    def reset(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._last_error = None
+            self._opened_at = None
+
+    def _create_error(self):
+        return ServiceUnavailableError(
+            f'{self.name} not available, please try again later '
+            f'({self._consecutive_failures} consecutive connection failures, last one: {self._last_error})')
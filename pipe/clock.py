@@ -0,0 +1,113 @@
+import time
+from contextvars import ContextVar
+from threading import Lock
+
+# How often an asynchronous wait checks the thread event it waits for
+WAKE_EVENT_CHECK_INTERVAL = 1
+
+
+class SystemClock:
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def sleep_async(self, seconds):
+        import asyncio
+
+        await asyncio.sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+    async def wait_async(self, event, timeout):
+        import asyncio
+
+        wake_up_at = self.monotonic() + timeout
+
+        while not event.is_set() and self.monotonic() < wake_up_at:
+            await asyncio.sleep(min(WAKE_EVENT_CHECK_INTERVAL, wake_up_at - self.monotonic()))
+
+        return event.is_set()
+
+
+class SimulatedClock:
+
+    def __init__(self, start=0, epoch=None):
+        self._now = start
+        self._epoch = time.time() if epoch is None else epoch
+        self._lock = Lock()
+        # Every thread or task keeps its own simulated time from its first
+        # reading on, so that callers sleeping at the same time do not add up
+        # their sleeps
+        self._caller_now = ContextVar(f'simulated_clock_{id(self)}', default=None)
+        self.sleep_count = 0
+        self.slept = 0
+
+    def monotonic(self):
+        caller_now = self._caller_now.get()
+
+        if caller_now is None:
+            with self._lock:
+                caller_now = self._now
+
+            self._caller_now.set(caller_now)
+
+        return caller_now
+
+    def time(self):
+        return self._epoch + self.monotonic()
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now = self._now + max(seconds, 0)
+            self._caller_now.set(self._now)
+
+    def sleep(self, seconds):
+        # The clock itself only moves on to the latest wake-up time
+        wake_up_at = self.monotonic() + max(seconds, 0)
+
+        with self._lock:
+            self._now = max(self._now, wake_up_at)
+            self.sleep_count = self.sleep_count + 1
+            self.slept = self.slept + max(seconds, 0)
+
+        self._caller_now.set(wake_up_at)
+
+    async def sleep_async(self, seconds):
+        import asyncio
+
+        self.sleep(seconds)
+        await asyncio.sleep(0)
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self.sleep(timeout)
+
+        return event.is_set()
+
+    async def wait_async(self, event, timeout):
+        import asyncio
+
+        woken_up = self.wait(event, timeout)
+        await asyncio.sleep(0)
+
+        return woken_up
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    global _clock
+
+    _clock = clock
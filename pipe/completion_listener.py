@@ -0,0 +1,120 @@
+import hmac
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+from bitbucket_pipes_toolkit import Pipe
+
+CALLBACK_PATH = '/analysis-finished'
+
+# Callbacks without this header carrying the configured secret are rejected
+CALLBACK_SECRET_HEADER = 'X-OpenQualityChecker-Secret'
+
+
+class CompletionListener:
+
+    def __init__(self, pipe, host, port, secret):
+        self._pipe: Pipe = pipe
+        self._secret = secret.encode('utf-8')
+        self._events = {}
+        self._finished_commits = set()
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever, name='completion-listener', daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+        self._pipe.log_info(
+            f'Listening for analysis finished callbacks on port {self.port}, path: {CALLBACK_PATH}')
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_event(self, oqc_project_name, commit_hash):
+        with self._lock:
+            event = self._events.setdefault((oqc_project_name, commit_hash), Event())
+
+            if commit_hash in self._finished_commits:
+                event.set()
+
+            return event
+
+    def notify(self, commit_hash, oqc_project_name=None):
+        with self._lock:
+            if oqc_project_name is None:
+                self._finished_commits.add(commit_hash)
+            else:
+                self._events.setdefault((oqc_project_name, commit_hash), Event())
+
+            events = [event for (project_name, event_commit_hash), event in self._events.items()
+                      if event_commit_hash == commit_hash
+                      and oqc_project_name in (None, project_name)]
+
+        for event in events:
+            event.set()
+
+        return len(events)
+
+    def is_authorized(self, secret):
+        return secret is not None and hmac.compare_digest(secret.encode('utf-8'), self._secret)
+
+    def _create_handler(self):
+        listener = self
+
+        class CompletionCallbackHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                url = urlparse(self.path)
+
+                if url.path != CALLBACK_PATH:
+                    self._respond(404)
+                    return
+
+                if not listener.is_authorized(self.headers.get(CALLBACK_SECRET_HEADER)):
+                    listener._pipe.log_warning('Rejected an analysis finished callback without a valid secret')
+                    self._respond(401)
+                    return
+
+                callback = {key: values[0] for key, values in parse_qs(url.query).items()}
+                content_length = int(self.headers.get('Content-Length') or 0)
+
+                try:
+                    if content_length:
+                        callback.update(json.loads(self.rfile.read(content_length)))
+                except (ValueError, TypeError):
+                    self._respond(400)
+                    return
+
+                commit_hash = callback.get('hash')
+
+                if not commit_hash:
+                    self._respond(400)
+                    return
+
+                oqc_project_name = callback.get('project')
+
+                listener._pipe.log_debug(
+                    f"Analysis finished callback received for project: '{oqc_project_name}' "
+                    f"and commit: '{commit_hash}'")
+
+                listener.notify(commit_hash, oqc_project_name)
+
+                self._respond(204)
+
+            def log_message(self, format, *args):
+                listener._pipe.log_debug(f'Completion listener: {format % args}')
+
+            def _respond(self, status_code):
+                self.send_response(status_code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return CompletionCallbackHandler
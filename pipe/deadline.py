@@ -0,0 +1,39 @@
+from clock import get_clock
+
+# The default maximum number of seconds a pipe run waits for the analysis
+# results of all of its projects
+DEFAULT_TIMEOUT = 3600
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class Deadline:
+
+    def __init__(self, timeout, clock=None):
+        self._timeout = timeout
+        self._clock = clock or get_clock()
+        self._expires_at = self._clock.monotonic() + timeout
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def remaining(self):
+        return max(self._expires_at - self._clock.monotonic(), 0)
+
+    def limit(self, timeout):
+        return min(timeout, self.remaining())
+
+    def check(self):
+        if self.expired:
+            raise self.create_error()
+
+    def create_error(self, last_error=None):
+        message = f'OpenQualityChecker did not finish within {self._timeout} s'
+
+        if last_error is not None:
+            message = f'{message}, last error: {last_error}'
+
+        return DeadlineExceededError(message)
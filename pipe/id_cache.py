@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+from bitbucket_pipes_toolkit import Pipe
+
+from atomic_file import write_file_atomically
+from clock import get_clock
+
+CACHE_FILE_NAME = 'openqualitychecker-ids.json'
+
+# The default number of seconds a cached id is trusted for
+DEFAULT_CACHE_TTL = 86400
+
+
+class IdCache:
+
+    def __init__(self, pipe, cache_dir, ttl, scope, clock=None):
+        self._pipe: Pipe = pipe
+        self._clock = clock or get_clock()
+        self._cache_file = os.path.join(cache_dir, CACHE_FILE_NAME) if cache_dir else None
+        self._ttl = ttl
+        self._scope = hashlib.sha256(scope.encode('utf-8')).hexdigest()[:16]
+        self._lock = Lock()
+        self._entries = self._load()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(self._entry_key(key))
+
+        if entry is None or self._is_expired(entry):
+            return None
+
+        return entry['id']
+
+    def put(self, key, value):
+        if not self._cache_file:
+            return
+
+        with self._lock:
+            self._entries[self._entry_key(key)] = {
+                'id': value,
+                'created': self._clock.time()
+            }
+            self._save()
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(self._entry_key(key), None) is None:
+                return False
+
+            self._save()
+
+        self._pipe.log_debug(f"Invalidated cached id: {'/'.join(map(str, key))}")
+
+        return True
+
+    def _entry_key(self, key):
+        return '/'.join([self._scope, *map(str, key)])
+
+    def _is_expired(self, entry):
+        return self._clock.time() - entry.get('created', 0) > self._ttl
+
+    def _load(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return {}
+
+        try:
+            with open(self._cache_file) as cache_file:
+                entries = json.load(cache_file).get('entries', {})
+        except (OSError, ValueError, AttributeError) as error:
+            self._pipe.log_warning(f'Ignoring unreadable id cache {self._cache_file}: {error}')
+            return {}
+
+        entries = {key: entry for key, entry in entries.items() if not self._is_expired(entry)}
+
+        self._pipe.log_debug(f'Loaded {len(entries)} cached ids from {self._cache_file}')
+
+        return entries
+
+    def _save(self):
+        try:
+            write_file_atomically(self._cache_file, json.dumps({'entries': self._entries}))
+        except OSError as error:
+            self._pipe.log_warning(f'Could not write id cache {self._cache_file}: {error}')
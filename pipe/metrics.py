@@ -0,0 +1,231 @@
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from atomic_file import write_file_atomically
+
+SUMMARY_FILE_NAME = 'openqualitychecker-metrics.json'
+PROMETHEUS_FILE_NAME = 'openqualitychecker-metrics.prom'
+
+METRIC_PREFIX = 'openqualitychecker_pipe'
+
+# Upper bounds in seconds of the latency histogram buckets, chosen so that
+# histograms of many runs can be summed up to percentiles
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Upper bounds in seconds of the stage duration histogram buckets, a stage
+# includes waiting for the analysis and may take up to an hour
+STAGE_BUCKETS = (1, 5, 30, 60, 300, 900, 1800, 3600)
+
+PERCENTILES = (50, 90, 99)
+
+# Path segments that identify a single entity, like numeric ids, commit
+# hashes and uuids, are replaced so that requests group by endpoint
+_ID_SEGMENT = re.compile(r'/(\d+|[0-9a-f]{7,40}|\{?[0-9a-f]{8}-[0-9a-f-]{27}\}?|openqualitychecker-[^/]+)(?=/|$)',
+                         re.IGNORECASE)
+
+_metrics_recorder = None
+_metrics_recorder_lock = Lock()
+
+
+def get_metrics_recorder():
+    global _metrics_recorder
+
+    with _metrics_recorder_lock:
+        if _metrics_recorder is None:
+            _metrics_recorder = MetricsRecorder()
+
+        return _metrics_recorder
+
+
+def set_metrics_recorder(metrics_recorder):
+    global _metrics_recorder
+
+    with _metrics_recorder_lock:
+        _metrics_recorder = metrics_recorder
+
+
+def normalize_endpoint(path):
+    return _ID_SEGMENT.sub('/{id}', path.split('?', 1)[0])
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+
+    ordered_values = sorted(values)
+    index = min(int(round(percent / 100 * (len(ordered_values) - 1))), len(ordered_values) - 1)
+
+    return ordered_values[index]
+
+
+class MetricsRecorder:
+
+    def __init__(self):
+        self._started = time.monotonic()
+        self._requests = []
+        self._stages = []
+        self._decodings = []
+        self._lock = Lock()
+
+    def record_request(self, service, method, path, status, latency, size, retries):
+        with self._lock:
+            self._requests.append({
+                'service': service,
+                'method': method,
+                'endpoint': normalize_endpoint(path),
+                'status': status if status is not None else 'error',
+                'latency': latency,
+                'bytes': size,
+                'retries': retries
+            })
+
+    def record_stage(self, stage, oqc_project_name, duration):
+        with self._lock:
+            self._stages.append({
+                'stage': stage,
+                'project': oqc_project_name,
+                'duration': duration
+            })
+
+    def record_decoding(self, service, path, size, duration):
+        with self._lock:
+            self._decodings.append({
+                'service': service,
+                'endpoint': normalize_endpoint(path),
+                'bytes': size,
+                'duration': duration
+            })
+
+    @contextmanager
+    def time_stage(self, stage, oqc_project_name):
+        started = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.record_stage(stage, oqc_project_name, time.monotonic() - started)
+
+    def get_summary(self):
+        with self._lock:
+            requests = list(self._requests)
+            stages = list(self._stages)
+            decodings = list(self._decodings)
+
+        return {
+            'duration': time.monotonic() - self._started,
+            'requests': self._summarize(requests, ('service', 'method', 'endpoint'), 'latency', LATENCY_BUCKETS),
+            'stages': self._summarize(stages, ('stage', 'project'), 'duration', STAGE_BUCKETS),
+            'decoding': self._summarize(decodings, ('service', 'endpoint'), 'duration', LATENCY_BUCKETS)
+        }
+
+    def _summarize(self, records, keys, duration_key, buckets):
+        groups = {}
+
+        for record in records:
+            groups.setdefault(tuple(record[key] for key in keys), []).append(record)
+
+        summary = []
+
+        for group_key, group_records in groups.items():
+            durations = [record[duration_key] for record in group_records]
+            group_summary = dict(zip(keys, group_key))
+
+            group_summary['count'] = len(group_records)
+            group_summary['total'] = sum(durations)
+            group_summary['max'] = max(durations)
+            group_summary.update({f'p{percent}': percentile(durations, percent) for percent in PERCENTILES})
+            group_summary['buckets'] = {f'{bucket}': sum(1 for duration in durations if duration <= bucket)
+                                        for bucket in buckets}
+
+            if duration_key == 'latency':
+                group_summary['statuses'] = {}
+
+                for record in group_records:
+                    status = f"{record['status']}"
+                    group_summary['statuses'][status] = group_summary['statuses'].get(status, 0) + 1
+
+                group_summary['retries'] = sum(record['retries'] for record in group_records)
+
+            if 'bytes' in group_records[0]:
+                group_summary['bytes'] = sum(record['bytes'] or 0 for record in group_records)
+
+            summary.append(group_summary)
+
+        return summary
+
+    def write(self, directory):
+        summary = self.get_summary()
+
+        write_file_atomically(os.path.join(directory, SUMMARY_FILE_NAME), json.dumps(summary, indent=2))
+        write_file_atomically(os.path.join(directory, PROMETHEUS_FILE_NAME), self._to_prometheus(summary))
+
+    def _to_prometheus(self, summary):
+        lines = [
+            f'# HELP {METRIC_PREFIX}_run_duration_seconds Wall clock time of the pipe run.',
+            f'# TYPE {METRIC_PREFIX}_run_duration_seconds gauge',
+            f"{METRIC_PREFIX}_run_duration_seconds {summary['duration']:.6f}"
+        ]
+
+        lines.extend(self._histogram_lines(
+            'http_request_duration_seconds', 'Latency of the HTTP requests sent by the pipe.',
+            summary['requests'], ('service', 'method', 'endpoint')))
+
+        lines.extend([
+            f'# HELP {METRIC_PREFIX}_http_requests_total Number of HTTP requests sent by the pipe.',
+            f'# TYPE {METRIC_PREFIX}_http_requests_total counter'
+        ])
+
+        for request in summary['requests']:
+            for status, count in request['statuses'].items():
+                labels = self._labels(request, ('service', 'method', 'endpoint'), status=status)
+                lines.append(f'{METRIC_PREFIX}_http_requests_total{{{labels}}} {count}')
+
+        for name, key, description in (('http_response_bytes_total', 'bytes', 'Bytes received by the pipe.'),
+                                       ('http_retries_total', 'retries', 'Requests sent again by the pipe.')):
+            lines.extend([
+                f'# HELP {METRIC_PREFIX}_{name} {description}',
+                f'# TYPE {METRIC_PREFIX}_{name} counter'
+            ])
+
+            for request in summary['requests']:
+                labels = self._labels(request, ('service', 'method', 'endpoint'))
+                lines.append(f'{METRIC_PREFIX}_{name}{{{labels}}} {request[key]}')
+
+        lines.extend(self._histogram_lines(
+            'stage_duration_seconds', 'Time spent in the stages of evaluating a project.',
+            summary['stages'], ('stage', 'project')))
+
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, name, description, groups, keys):
+        lines = [
+            f'# HELP {METRIC_PREFIX}_{name} {description}',
+            f'# TYPE {METRIC_PREFIX}_{name} histogram'
+        ]
+
+        for group in groups:
+            for bucket, count in group['buckets'].items():
+                labels = self._labels(group, keys, le=bucket)
+                lines.append(f'{METRIC_PREFIX}_{name}_bucket{{{labels}}} {count}')
+
+            labels = self._labels(group, keys)
+
+            lines.extend([
+                f"{METRIC_PREFIX}_{name}_bucket{{{self._labels(group, keys, le='+Inf')}}} {group['count']}",
+                f"{METRIC_PREFIX}_{name}_sum{{{labels}}} {group['total']:.6f}",
+                f"{METRIC_PREFIX}_{name}_count{{{labels}}} {group['count']}"
+            ])
+
+        return lines
+
+    def _labels(self, group, keys, **extra_labels):
+        labels = [(key, group[key]) for key in keys] + list(extra_labels.items())
+
+        return ','.join(f'{key}="{self._escape(value)}"' for key, value in labels)
+
+    def _escape(self, value):
+        return f'{value}'.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,138 +1,260 @@
-import backoff
+import json
+from abc import ABC, abstractmethod
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock
+from urllib.parse import urlparse
+
 import requests
 from bitbucket_pipes_toolkit import Pipe
-from requests import HTTPError
+from requests import HTTPError, RequestException
+from requests.exceptions import ConnectionError, Timeout
+
+from circuit_breaker import UNAVAILABLE_STATUS_CODES, CircuitBreaker, ServiceUnavailableError
+from deadline import Deadline, DeadlineExceededError
+from metrics import get_metrics_recorder
+from rate_limiter import RateLimitedAdapter, RateLimiter, get_connection_stats
+from transport import create_transport_adapter
+
+# The number of keep-alive connections kept open per host during
+# a pipe run
+CONNECTION_POOL_SIZE = 10
+
+PROJECT_PAGE_SIZE = 100
+
+# The maximum number of project pages downloaded at the same time
+PROJECT_PAGE_WORKERS = 4
+
+# The maximum number of seconds to wait for the server to answer a request
+REQUEST_TIMEOUT = 30
+
+# The maximum number of seconds the availability check at startup waits
+AVAILABILITY_PROBE_TIMEOUT = 5
 
-# The maximum total amount of time in seconds to try for before
-# giving up
-MAX_BACKOFF_TIMEOUT = 3600
+SERVICE_NAME = 'OpenQualityChecker'
 
+SERVICE_UNAVAILABLE_MESSAGE = f'{SERVICE_NAME} not available, please try again later'
 
-class OpenQualityCheckerApi:
 
-    def __init__(self, pipe):
+class BaseOpenQualityCheckerApi(ABC):
+
+    def __init__(self, pipe, deadline=None, rate_limiter=None, circuit_breaker=None):
         self._pipe: Pipe = pipe
+        self._deadline: Deadline = deadline
         self._oqc_api_token = self._pipe.get_variable('OPENQUALITYCHECKER_ACCESS_TOKEN')
+        self._base_url = self._pipe.get_variable('OPENQUALITYCHECKER_BASE_URL')
+        self._rate_limiter: RateLimiter = rate_limiter or RateLimiter(SERVICE_NAME)
+        self._circuit_breaker: CircuitBreaker = circuit_breaker or CircuitBreaker(SERVICE_NAME)
+        self._metrics = get_metrics_recorder()
+        self._validated_responses = {}
+        self._validator_lock = Lock()
+        self._bytes_saved = 0
 
         self._pipe.log_debug(
-            f'OpenQualityCheckerApi initialized with API token: {self._oqc_api_token}')
+            f'{type(self).__name__} initialized with API token: {self._oqc_api_token}')
 
-    def get_projects(self):
-        size = 100
+    def get_projects_page(self, page):
+        params = {
+            'privateOnly': 'true',
+            'page': page,
+            'size': PROJECT_PAGE_SIZE
+        }
 
-        page = 1
-        projects = []
-        last_page = False
+        return self._get_data('/api/projects', params=params, raise_errors=True)
 
-        try:
-            while not last_page:
-                params = {
-                    'privateOnly': 'true',
-                    'page': page,
-                    'size': size
-                }
-                headers = {
-                    'token': self._oqc_api_token
-                }
+    def get_branches(self, project_id):
+        return self._get_data(f'/api/project/{project_id}/branches', [])
 
-                projects_response = requests.get(
-                    f"{self._pipe.get_variable('OPENQUALITYCHECKER_BASE_URL')}/api/projects",
-                    headers=headers, params=params)
+    def get_version(self, branch_id):
+        return self._get_data(f'/api/branch/{branch_id}/versions', [], conditional=True)
 
-                projects_response.raise_for_status()
+    def get_quality_profile(self, version_id):
+        return self._get_data(f'/api/version/{version_id}/qualityProfile', conditional=True)
 
-                response_body = projects_response.json()
+    @abstractmethod
+    def _get_data(self, path, default=None, raise_errors=False, **kwargs):
+        pass
 
-                if not response_body:
-                    self._pipe.log_warning('OPENQUALITYCHECKER__ERROR')
-                    break
+    @abstractmethod
+    def _get_error_status(self, error):
+        pass
 
-                response_data = response_body['data']
+    def _prepare_request(self, path, params, conditional):
+        url = f'{self._base_url}{path}'
+        validator_key = (url, tuple(sorted((params or {}).items())))
+        validated_response = self._validated_responses.get(validator_key) if conditional else None
 
-                if response_data:
-                    last_page = response_data['last']
-                    response_project_list = response_data['content']
+        headers = {}
 
-                    if response_project_list:
-                        projects.extend(response_project_list)
-                else:
-                    last_page = True
+        if validated_response:
+            if validated_response['etag']:
+                headers['If-None-Match'] = validated_response['etag']
+            if validated_response['last_modified']:
+                headers['If-Modified-Since'] = validated_response['last_modified']
 
-                page = page + 1
-        except HTTPError as error:
-            if error.response.status_code == 403:
-                self._pipe.log_warning(f'OPENQUALITYCHECKER__ERROR: Request not authorized')
-                raise ValueError(f'Request not authorized, possible invalid API token')
+        return url, validator_key, headers
 
-            self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
-            raise ValueError(f'{error}')
-        except Exception as error:
-            self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
-            raise ValueError(f'OpenQualityChecker not available, please try again later')
+    def _record_status(self, status, reason):
+        if status in UNAVAILABLE_STATUS_CODES:
+            self._circuit_breaker.record_failure(f'{status} {reason}')
+        else:
+            self._circuit_breaker.record_success()
 
-        return projects
+    def _read_response(self, url, validator_key, status, headers, content, conditional):
+        validated_response = self._validated_responses.get(validator_key) if conditional else None
 
-    def get_branches(self, project_id):
-        branches = []
-        try:
-            headers = {
-                'token': self._oqc_api_token
-            }
+        if validated_response and status == 304:
+            with self._validator_lock:
+                self._bytes_saved += validated_response['size']
 
-            projects_response = requests.get(
-                f"{self._pipe.get_variable('OPENQUALITYCHECKER_BASE_URL')}/api/project/{project_id}/branches",
-                headers=headers)
+            self._pipe.log_debug(
+                f"{url} not modified, reused {validated_response['size']} bytes "
+                f"({self._bytes_saved} bytes saved so far)")
 
-            projects_response.raise_for_status()
+            return validated_response['body']
 
-            response_body = projects_response.json()
+        started = time.perf_counter()
+        response_body = json.loads(content)
+        self._metrics.record_decoding(SERVICE_NAME, urlparse(url).path, len(content), time.perf_counter() - started)
 
-            branches = response_body.get('data')
+        if conditional and (headers.get('ETag') or headers.get('Last-Modified')):
+            self._validated_responses[validator_key] = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'body': response_body,
+                'size': len(content)
+            }
 
-        except Exception as error:
+        return response_body
+
+    def _read_data(self, response_body):
+        return response_body.get('data')
+
+    def _handle_error(self, error, default, raise_errors):
+        if isinstance(error, (ServiceUnavailableError, DeadlineExceededError)):
+            raise error
+
+        if not raise_errors:
             self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
+            return default
 
-        return branches
+        status = self._get_error_status(error)
 
-    @backoff.on_predicate(backoff.fibo, max_value=100, max_time=MAX_BACKOFF_TIMEOUT)
-    def get_version(self, branch_id):
-        versions = []
-        try:
-            headers = {
-                'token': self._oqc_api_token
-            }
+        if status == 403:
+            self._pipe.log_warning(f'OPENQUALITYCHECKER__ERROR: Request not authorized')
+            raise ValueError(f'Request not authorized, possible invalid API token')
+
+        self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
+        raise ValueError(f'{error}' if status is not None else SERVICE_UNAVAILABLE_MESSAGE)
 
-            projects_response = requests.get(
-                f"{self._pipe.get_variable('OPENQUALITYCHECKER_BASE_URL')}/api/branch/{branch_id}/versions",
-                headers=headers)
+    def _request_timeout(self):
+        if self._deadline is None:
+            return REQUEST_TIMEOUT
 
-            projects_response.raise_for_status()
+        self._deadline.check()
 
-            response_body = projects_response.json()
+        return self._deadline.limit(REQUEST_TIMEOUT)
 
-            versions = response_body.get('data')
+    def _check_availability_status(self, status, reason):
+        if status in UNAVAILABLE_STATUS_CODES:
+            self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {status} {reason}')
+            raise ServiceUnavailableError(SERVICE_UNAVAILABLE_MESSAGE)
 
+        self._pipe.log_debug(f'{SERVICE_NAME} is available, status of the base URL: {status}')
+
+    def _raise_unavailable(self, error):
+        self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
+        raise ServiceUnavailableError(SERVICE_UNAVAILABLE_MESSAGE)
+
+    def _log_stats(self):
+        stats = self.get_connection_stats()
+        rate_limiter_stats = self._rate_limiter.get_stats()
+
+        self._pipe.log_debug(
+            f"OpenQualityChecker connections opened: {stats['connections']}, "
+            f"requests sent: {stats['requests']}, "
+            f"bytes saved by conditional requests: {self._bytes_saved}, "
+            f"requests throttled: {rate_limiter_stats['throttled_requests']} "
+            f"for {rate_limiter_stats['throttled_time']:.1f} s, "
+            f"rate limited responses: {rate_limiter_stats['rate_limited_responses']}")
+
+    @abstractmethod
+    def get_connection_stats(self):
+        pass
+
+
+class OpenQualityCheckerApi(BaseOpenQualityCheckerApi):
+
+    def __init__(self, pipe, deadline=None, rate_limiter=None, circuit_breaker=None):
+        super().__init__(pipe, deadline, rate_limiter, circuit_breaker)
+        self._session = self._create_session()
+
+    def _create_session(self):
+        adapter = RateLimitedAdapter(self._rate_limiter, self._pipe.logger,
+                                     transport=create_transport_adapter(pool_connections=CONNECTION_POOL_SIZE,
+                                                                        pool_maxsize=CONNECTION_POOL_SIZE),
+                                     pool_connections=CONNECTION_POOL_SIZE,
+                                     pool_maxsize=CONNECTION_POOL_SIZE)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'token': self._oqc_api_token,
+            'Connection': 'keep-alive'
+        })
+
+        return session
+
+    def _get(self, path, params=None, conditional=False):
+        url, validator_key, headers = self._prepare_request(path, params, conditional)
+
+        self._circuit_breaker.check()
+
+        try:
+            response = self._session.get(url, params=params, headers=headers, timeout=self._request_timeout())
+        except (ConnectionError, Timeout) as error:
+            self._circuit_breaker.record_failure(error)
+            raise
+
+        self._record_status(response.status_code, response.reason)
+
+        response.raise_for_status()
+
+        return self._read_response(url, validator_key, response.status_code, response.headers, response.content,
+                                   conditional)
+
+    def _get_data(self, path, default=None, raise_errors=False, **kwargs):
+        try:
+            return self._read_data(self._get(path, **kwargs))
         except Exception as error:
-            self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
+            return self._handle_error(error, default, raise_errors)
 
-        return versions
+    def _get_error_status(self, error):
+        return error.response.status_code if isinstance(error, HTTPError) else None
 
-    @backoff.on_predicate(backoff.fibo, max_value=100, max_time=MAX_BACKOFF_TIMEOUT)
-    def get_quality_profile(self, version_id):
+    def check_availability(self):
         try:
-            headers = {
-                'token': self._oqc_api_token
-            }
+            response = self._session.get(self._base_url, timeout=AVAILABILITY_PROBE_TIMEOUT)
+        except RequestException as error:
+            self._raise_unavailable(error)
 
-            projects_response = requests.get(
-                f"{self._pipe.get_variable('OPENQUALITYCHECKER_BASE_URL')}/api/version/{version_id}/qualityProfile",
-                headers=headers)
+        self._check_availability_status(response.status_code, response.reason)
 
-            projects_response.raise_for_status()
+    def get_connection_stats(self):
+        return get_connection_stats(self._session)
 
-            response_body = projects_response.json()
+    def close(self):
+        self._log_stats()
 
-            return response_body.get('data')
+        self._session.close()
 
-        except Exception as error:
-            self._pipe.log_error(f'OPENQUALITYCHECKER__ERROR: {error}')
+    def get_projects_pages(self, pages):
+        if len(pages) == 1:
+            return [self.get_projects_page(pages[0])]
+
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+            page_futures = [executor.submit(copy_context().run, self.get_projects_page, page) for page in pages]
+
+            return [page_future.result() for page_future in page_futures]
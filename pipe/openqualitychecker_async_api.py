@@ -0,0 +1,138 @@
+import asyncio
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import ClientResponseError
+
+from metrics import normalize_endpoint
+from openqualitychecker_api import AVAILABILITY_PROBE_TIMEOUT, CONNECTION_POOL_SIZE, \
+    REQUEST_TIMEOUT, SERVICE_NAME, BaseOpenQualityCheckerApi
+from rate_limiter import MAX_RATE_LIMITED_RETRIES, parse_retry_after
+from tracing import start_span
+
+
+class AsyncOpenQualityCheckerApi(BaseOpenQualityCheckerApi):
+
+    def __init__(self, pipe, concurrency=CONNECTION_POOL_SIZE, deadline=None, rate_limiter=None,
+                 circuit_breaker=None):
+        super().__init__(pipe, deadline, rate_limiter, circuit_breaker)
+        self._concurrency = concurrency
+        self._session = None
+        self._connections = 0
+        self._requests_sent = 0
+
+    def _get_session(self):
+        if self._session is None:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection_created)
+            trace_config.on_request_start.append(self._on_request_started)
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._concurrency),
+                headers={'token': self._oqc_api_token},
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                trace_configs=[trace_config])
+
+        return self._session
+
+    async def _on_connection_created(self, session, context, params):
+        self._connections += 1
+
+    async def _on_request_started(self, session, context, params):
+        self._requests_sent += 1
+
+    async def _get(self, path, params=None, conditional=False):
+        url, validator_key, headers = self._prepare_request(path, params, conditional)
+        retries = 0
+
+        while True:
+            await self._rate_limiter.acquire_async()
+
+            self._circuit_breaker.check()
+
+            with start_span('http_request', service=SERVICE_NAME, method='GET',
+                            endpoint=normalize_endpoint(urlparse(url).path), retries=retries) as span:
+                started = time.monotonic()
+
+                try:
+                    response = await self._get_session().get(
+                        url, params=params, headers=headers,
+                        timeout=aiohttp.ClientTimeout(total=self._request_timeout()))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                    self._record_request(url, None, started, retries)
+                    self._circuit_breaker.record_failure(error)
+                    raise
+
+                span.set_attribute('status', response.status)
+
+                async with response:
+                    self._record_status(response.status, response.reason)
+
+                    if response.status != 429 or retries >= MAX_RATE_LIMITED_RETRIES:
+                        try:
+                            response.raise_for_status()
+
+                            return self._read_response(url, validator_key, response.status, response.headers,
+                                                       await response.read(), conditional)
+                        finally:
+                            self._record_request(url, response, started, retries)
+
+                    self._record_request(url, response, started, retries)
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'), self._rate_limiter.clock)
+            retries = retries + 1
+
+            self._pipe.log_warning(
+                f"{SERVICE_NAME} rate limit reached, sending request again in {retry_after:.1f} s "
+                f"(retry {retries} of {MAX_RATE_LIMITED_RETRIES})")
+
+            self._rate_limiter.penalize(retry_after)
+
+    def _record_request(self, url, response, started, retries):
+        self._metrics.record_request(SERVICE_NAME,
+                                     'GET',
+                                     urlparse(url).path,
+                                     response.status if response is not None else None,
+                                     time.monotonic() - started,
+                                     response.content.total_bytes if response is not None else None,
+                                     retries)
+
+    async def _get_data(self, path, default=None, raise_errors=False, **kwargs):
+        try:
+            return self._read_data(await self._get(path, **kwargs))
+        except Exception as error:
+            return self._handle_error(error, default, raise_errors)
+
+    def _get_error_status(self, error):
+        return error.status if isinstance(error, ClientResponseError) else None
+
+    async def check_availability(self):
+        with start_span('http_request', service=SERVICE_NAME, method='GET',
+                        endpoint=normalize_endpoint(urlparse(self._base_url).path), retries=0) as span:
+            try:
+                async with self._get_session().get(
+                        self._base_url, timeout=aiohttp.ClientTimeout(total=AVAILABILITY_PROBE_TIMEOUT)) as response:
+                    status = response.status
+                    reason = response.reason
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                self._raise_unavailable(error)
+
+            span.set_attribute('status', status)
+
+        self._check_availability_status(status, reason)
+
+    def get_connection_stats(self):
+        return {
+            'connections': self._connections,
+            'requests': self._requests_sent
+        }
+
+    async def close(self):
+        self._log_stats()
+
+        if self._session is not None:
+            await self._session.close()
+
+    async def get_projects_pages(self, pages):
+        return await asyncio.gather(*[self.get_projects_page(page) for page in pages])
@@ -0,0 +1,29 @@
+import asyncio
+
+from openqualitychecker_async_api import AsyncOpenQualityCheckerApi
+from openqualitychecker_service import BaseOpenQualityCheckerService
+from steps import run_steps_async
+
+
+class AsyncOpenQualityCheckerService(BaseOpenQualityCheckerService):
+
+    def __init__(self, pipe, concurrency, clock=None):
+        self._concurrency = concurrency
+        super().__init__(pipe, clock, asynchronous=True)
+
+    def _create_api(self, pipe, deadline, rate_limiter, circuit_breaker):
+        return AsyncOpenQualityCheckerApi(pipe, self._concurrency, deadline, rate_limiter, circuit_breaker)
+
+    def _create_lock(self):
+        return asyncio.Lock()
+
+    async def check_availability(self):
+        await self._open_quality_checker_api.check_availability()
+
+    async def get_quality_result(self, oqc_project_name, branch_name, commit_hash):
+        return await run_steps_async(self._get_quality_result(oqc_project_name, branch_name, commit_hash))
+
+    async def close(self):
+        self._stop_completion_listener()
+
+        await self._open_quality_checker_api.close()
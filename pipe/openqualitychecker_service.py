@@ -1,57 +1,240 @@
-import backoff
-from bitbucket_pipes_toolkit import Pipe
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock
+
+from bitbucket_pipes_toolkit import Pipe, fail
 from colorlog import colorlog
 
-from openqualitychecker_api import OpenQualityCheckerApi, MAX_BACKOFF_TIMEOUT
+from circuit_breaker import CircuitBreaker
+from deadline import Deadline
+from id_cache import IdCache
+from metrics import get_metrics_recorder
+from openqualitychecker_api import PROJECT_PAGE_WORKERS, SERVICE_NAME, OpenQualityCheckerApi
+from polling import AnalysisDurationHistory, PollingScheduler
+from project_index import ProjectIndex
+from rate_limiter import RateLimiter
+from steps import run_steps, single_step, with_lock
+from tracing import start_span
+from version_tracker import VersionTracker
+
+STAGE_NOT_STARTED = 'not started'
+STAGE_RESOLVING_IDS = 'resolving the project and branch ids'
+STAGE_WAITING_FOR_VERSION = 'waiting for the analyzed version of the commit'
+STAGE_WAITING_FOR_QUALITY_PROFILE = 'waiting for the quality profile'
+STAGE_FINISHED = 'finished'
+
+
+def configure_log_format(pipe):
+    pipe.logger.handlers.__getitem__(0).setFormatter(colorlog.ColoredFormatter(
+        '%(log_color)s%(asctime)s %(levelname)-6s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+
+
+@contextmanager
+def track_stage(stage, oqc_project_name):
+    with get_metrics_recorder().time_stage(stage, oqc_project_name), start_span(stage, project=oqc_project_name):
+        yield
+
+
+def create_id_cache(pipe, clock=None):
+    return IdCache(pipe,
+                   pipe.get_variable('OPENQUALITYCHECKER_CACHE_DIR'),
+                   pipe.get_variable('OPENQUALITYCHECKER_CACHE_TTL'),
+                   scope=f"{pipe.get_variable('OPENQUALITYCHECKER_BASE_URL')}|"
+                         f"{pipe.get_variable('OPENQUALITYCHECKER_ACCESS_TOKEN')}",
+                   clock=clock)
+
+
+def create_deadline(pipe, clock=None):
+    return Deadline(pipe.get_variable('OPENQUALITYCHECKER_TIMEOUT'), clock)
+
+
+def create_rate_limiter(pipe, clock=None):
+    return RateLimiter(SERVICE_NAME, pipe.get_variable('OPENQUALITYCHECKER_RATE_LIMIT'), clock)
+
+
+def create_polling_scheduler(pipe, deadline, clock=None):
+    return PollingScheduler(
+        pipe,
+        AnalysisDurationHistory(pipe, pipe.get_variable('OPENQUALITYCHECKER_CACHE_DIR')),
+        min_interval=pipe.get_variable('OPENQUALITYCHECKER_POLL_MIN_INTERVAL'),
+        max_interval=pipe.get_variable('OPENQUALITYCHECKER_POLL_MAX_INTERVAL'),
+        jitter=pipe.get_variable('OPENQUALITYCHECKER_POLL_JITTER'),
+        deadline=deadline,
+        clock=clock)
+
+
+def start_completion_listener(pipe):
+    callback_port = pipe.get_variable('OPENQUALITYCHECKER_CALLBACK_PORT')
 
+    if callback_port is None:
+        return None
 
-class OpenQualityCheckerService:
+    callback_secret = pipe.get_variable('OPENQUALITYCHECKER_CALLBACK_SECRET')
 
-    def __init__(self, pipe):
+    if not callback_secret:
+        fail('OPENQUALITYCHECKER_CALLBACK_SECRET is required when OPENQUALITYCHECKER_CALLBACK_PORT is set')
+
+    from completion_listener import CompletionListener
+
+    completion_listener = CompletionListener(pipe,
+                                             pipe.get_variable('OPENQUALITYCHECKER_CALLBACK_HOST'),
+                                             callback_port,
+                                             callback_secret)
+    completion_listener.start()
+
+    return completion_listener
+
+
+class BaseOpenQualityCheckerService(ABC):
+
+    def __init__(self, pipe, clock=None, asynchronous=False):
         self._pipe: Pipe = pipe
-        self._pipe.logger.handlers.__getitem__(0).setFormatter(colorlog.ColoredFormatter(
-            '%(log_color)s%(asctime)s %(levelname)-6s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
-        self._open_quality_checker_api = OpenQualityCheckerApi(pipe)
+        configure_log_format(pipe)
+        self._asynchronous = asynchronous
+        self._deadline = create_deadline(pipe, clock)
+        self._open_quality_checker_api = self._create_api(pipe, self._deadline,
+                                                          create_rate_limiter(pipe, clock),
+                                                          CircuitBreaker(SERVICE_NAME, clock=clock))
+        self._id_cache = create_id_cache(pipe, clock)
+        self._polling_scheduler = create_polling_scheduler(pipe, self._deadline, clock)
+        self._completion_listener = start_completion_listener(pipe)
+        self._project_index = ProjectIndex(pipe)
+        self._project_index_lock = self._create_lock()
+        self._project_stages = {}
+        self._version_tracker = VersionTracker()
 
-    def get_quality_result(self, oqc_project_name, branch_name, commit_hash):
-        oqc_project_id = self._find_project_id_by_name(oqc_project_name)
+    @abstractmethod
+    def _create_api(self, pipe, deadline, rate_limiter, circuit_breaker):
+        pass
+
+    @abstractmethod
+    def _create_lock(self):
+        pass
+
+    def cancel(self):
+        self._polling_scheduler.cancel()
+
+    def get_project_stages(self):
+        return dict(self._project_stages)
+
+    def _stop_completion_listener(self):
+        if self._completion_listener:
+            self._completion_listener.stop()
+
+    def _get_quality_result(self, oqc_project_name, branch_name, commit_hash):
+        with start_span('project', project=oqc_project_name, branch=branch_name, commit=commit_hash):
+            self._project_stages[oqc_project_name] = STAGE_RESOLVING_IDS
+
+            oqc_project_id, branch_id = yield from self._find_project_and_branch_id(oqc_project_name, branch_name)
+
+            self._project_stages[oqc_project_name] = STAGE_WAITING_FOR_VERSION
+
+            waiting_since = self._polling_scheduler.start_waiting()
+            wake_event = self._completion_listener.get_event(oqc_project_name, commit_hash) \
+                if self._completion_listener else None
 
-        branch_id = self._find_branch_id(oqc_project_name, oqc_project_id, branch_name)
-        version_id = self._find_version_id(oqc_project_name, branch_id, commit_hash)
-        return self._find_quality_profile(oqc_project_name, version_id)
+            with track_stage('find_version_id', oqc_project_name):
+                version_id = yield from self._find_version_id(oqc_project_name, branch_id, commit_hash,
+                                                              waiting_since, wake_event)
+
+            self._project_stages[oqc_project_name] = STAGE_WAITING_FOR_QUALITY_PROFILE
+
+            with track_stage('find_quality_profile', oqc_project_name):
+                quality = yield from self._find_quality_profile(oqc_project_name, version_id, waiting_since,
+                                                                wake_event)
+
+            self._project_stages[oqc_project_name] = STAGE_FINISHED
+
+            return quality
+
+    def _find_project_and_branch_id(self, oqc_project_name, branch_name):
+        project_cache_key = ('project', oqc_project_name)
+
+        oqc_project_id = self._id_cache.get(project_cache_key)
+
+        # Only the project id is cached, the branches of the project are
+        # always listed, which also checks that the cached id is still valid
+        # before the long polling starts
+        if oqc_project_id is not None:
+            self._pipe.log_info(f"[{oqc_project_name}] Using cached project id: '{oqc_project_id}'")
+
+            try:
+                with track_stage('find_branch_id', oqc_project_name):
+                    branch_id = yield from self._find_branch_id(oqc_project_name, oqc_project_id, branch_name)
+
+                return oqc_project_id, branch_id
+            except ValueError:
+                self._pipe.log_info(f"[{oqc_project_name}] Cached project id: '{oqc_project_id}' is stale, "
+                                    f"searching it again")
+
+                self._id_cache.invalidate(project_cache_key)
+
+        with track_stage('find_project_id_by_name', oqc_project_name):
+            oqc_project_id = yield from self._find_project_id_by_name(oqc_project_name)
+        self._id_cache.put(project_cache_key, oqc_project_id)
+
+        with track_stage('find_branch_id', oqc_project_name):
+            branch_id = yield from self._find_branch_id(oqc_project_name, oqc_project_id, branch_name)
+
+        return oqc_project_id, branch_id
 
     def _find_project_id_by_name(self, project_name):
 
         self._pipe.log_info(
             f"[{project_name}] Searching project id by name")
 
-        oqc_projects = self._open_quality_checker_api.get_projects()
+        project_id = yield from with_lock(self._project_index_lock, self._search_or_reload_project_index(project_name))
 
-        if not oqc_projects:
-            self._pipe.log_warning(
-                f"[{project_name}] No OpenQualityChecker project is found for the given token")
+        if project_id is None:
+            raise ValueError(f"[{project_name}] Project id NOT found for project name")
 
-        for oqc_project in oqc_projects:
-            current_project_name = oqc_project.get('projectName')
+        return project_id
 
-            self._pipe.log_debug(
-                f"[{project_name}] Current project name for checking: '{current_project_name}'")
+    def _search_or_reload_project_index(self, project_name):
+        reloadable = self._project_index.exhausted
+
+        project_id = yield from self._search_project_index(project_name)
+
+        if project_id is None and reloadable and self._project_index.reload():
+            self._pipe.log_info(
+                f"[{project_name}] Project name is not in the loaded project list, reloading it")
 
-            if current_project_name == project_name:
-                return oqc_project.get('id')
+            project_id = yield from self._search_project_index(project_name)
 
-        raise ValueError(f"[{project_name}] Project id NOT found for project name")
+        return project_id
 
-    @backoff.on_exception(backoff.fibo, ValueError, max_value=100, max_time=MAX_BACKOFF_TIMEOUT)
-    def _find_version_id(self, oqc_project_name, branch_id, commit_hash):
+    def _search_project_index(self, project_name):
+        while self._project_index.get(project_name) is None and not self._project_index.exhausted:
+            # Once the number of pages is known, the next few are downloaded
+            # at the same time
+            pages = self._project_index.next_pages(PROJECT_PAGE_WORKERS)
+            pages_data = yield self._open_quality_checker_api.get_projects_pages(pages)
+
+            for page_data in pages_data:
+                if not self._project_index.exhausted:
+                    self._project_index.add_page(project_name, page_data)
+
+        return self._project_index.get(project_name)
+
+    def _find_version_id(self, oqc_project_name, branch_id, commit_hash, waiting_since, wake_event):
+        return self._polling_scheduler.poll_steps(
+            oqc_project_name,
+            partial(self._search_version_id, oqc_project_name, branch_id, commit_hash),
+            waiting_since,
+            wake_event,
+            self._asynchronous)
+
+    def _search_version_id(self, oqc_project_name, branch_id, commit_hash):
         self._pipe.log_info(
             f"[{oqc_project_name}] Searching version for branch id: '{branch_id}' and commit: '{commit_hash}'")
 
-        versions = self._open_quality_checker_api.get_version(branch_id)
+        versions = yield self._open_quality_checker_api.get_version(branch_id)
 
-        for version in versions:
-            if version.get('hash') == commit_hash:
-                return version.get('id')
+        version_id = self._version_tracker.find_version_id(branch_id, versions, commit_hash)
+
+        if version_id is not None:
+            return version_id
 
         raise ValueError(
             f"[{oqc_project_name}] Version not found for branch id: '{branch_id}' and hash: '{commit_hash}'")
@@ -60,7 +243,7 @@ class OpenQualityCheckerService:
         self._pipe.log_info(
             f"[{oqc_project_name}] Searching branch id for project: '{oqc_project_id}' and branch name: '{branch_name}'")
 
-        branches = self._open_quality_checker_api.get_branches(oqc_project_id)
+        branches = yield self._open_quality_checker_api.get_branches(oqc_project_id)
 
         for branch in branches:
             current_branch_name = branch.get('branchName')
@@ -71,14 +254,41 @@ class OpenQualityCheckerService:
 
         raise ValueError(f"[{oqc_project_name}] Branch not found: '{branch_name}'")
 
-    def _find_quality_profile(self, oqc_project_name, version_id):
+    def _find_quality_profile(self, oqc_project_name, version_id, waiting_since, wake_event):
         self._pipe.log_info(
             f"[{oqc_project_name}] Searching quality profile for branch version: '{version_id}'")
 
-        quality = self._open_quality_checker_api.get_quality_profile(version_id)
+        quality = yield from self._polling_scheduler.poll_steps(
+            oqc_project_name,
+            partial(single_step, partial(self._open_quality_checker_api.get_quality_profile, version_id)),
+            waiting_since,
+            wake_event,
+            self._asynchronous)
 
         if quality is None:
             raise ValueError(
                 f"[{oqc_project_name}] No quality profile found for version: '{version_id}'")
 
+        self._polling_scheduler.record_analysis_duration(oqc_project_name, waiting_since)
+
         return quality
+
+
+class OpenQualityCheckerService(BaseOpenQualityCheckerService):
+
+    def _create_api(self, pipe, deadline, rate_limiter, circuit_breaker):
+        return OpenQualityCheckerApi(pipe, deadline, rate_limiter, circuit_breaker)
+
+    def _create_lock(self):
+        return Lock()
+
+    def check_availability(self):
+        self._open_quality_checker_api.check_availability()
+
+    def get_quality_result(self, oqc_project_name, branch_name, commit_hash):
+        return run_steps(self._get_quality_result(oqc_project_name, branch_name, commit_hash))
+
+    def close(self):
+        self._stop_completion_listener()
+
+        self._open_quality_checker_api.close()
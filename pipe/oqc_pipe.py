@@ -1,6 +1,17 @@
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from contextvars import copy_context
+from functools import partial
+
 from bitbucket_pipes_toolkit import Pipe, fail, success
 
-from openqualitychecker_service import OpenQualityCheckerService
+from deadline import DeadlineExceededError
+from metrics import get_metrics_recorder
+from openqualitychecker_service import STAGE_NOT_STARTED, OpenQualityCheckerService
+from polling import PollingCancelledError
+from tracing import JsonLinesExporter, set_exporter, start_span
+from transport import MODE_RECORD, Cassette, set_cassette
 
 
 def _get_failure_reason(results_of_rules):
@@ -20,6 +31,19 @@ def _get_failure_reason(results_of_rules):
     return details
 
 
+def _get_first_error(futures):
+    for future in futures:
+        if not future.done() or future.cancelled():
+            continue
+
+        error = future.exception()
+
+        if error is not None and not isinstance(error, PollingCancelledError):
+            return error
+
+    return None
+
+
 class OpenQualityCheckerPipe(Pipe):
 
     def __init__(self, pipe_metadata=None, pipe_metadata_file=None, schema=None,
@@ -28,57 +52,255 @@ class OpenQualityCheckerPipe(Pipe):
                          schema=schema, env=env,
                          check_for_newer_version=check_for_newer_version)
 
-        self._openqualitychecker_service = OpenQualityCheckerService(self)
+        self._async_mode = self.get_variable('OPENQUALITYCHECKER_ASYNC')
+
+        if self._async_mode and importlib.util.find_spec('aiohttp') is None:
+            fail('OPENQUALITYCHECKER_ASYNC needs the aiohttp package, build the image with ASYNC_SUPPORT=true')
+
+        self._cassette = self._create_cassette()
+        self._openqualitychecker_service = None if self._async_mode else OpenQualityCheckerService(self)
 
     def run(self):
         super().run()
 
         self.log_debug('Executing the pipe...')
 
+        trace_file = self.get_variable('OPENQUALITYCHECKER_TRACE_FILE')
+
+        if trace_file:
+            set_exporter(JsonLinesExporter(trace_file))
+
         oqc_project_name_parameter = self.get_variable('OPENQUALITYCHECKER_PROJECT_NAME')
         branch_name = self.get_variable('BITBUCKET_BRANCH')
         commit_hash = self.get_variable('BITBUCKET_COMMIT')
 
         try:
-            oqc_project_names = oqc_project_name_parameter.split(',')
-            total_quality_result = True
+            oqc_project_names = [name.strip() for name in oqc_project_name_parameter.split(',')]
 
-            for current_project in oqc_project_names:
-                current_project = current_project.strip()
-                quality_profile = self._openqualitychecker_service.get_quality_result(
-                    current_project,
-                    branch_name,
-                    commit_hash)
+            with start_span('run', projects=oqc_project_names, branch=branch_name, commit=commit_hash,
+                            async_mode=self._async_mode) as run_span:
+                if self._async_mode:
+                    import asyncio
 
-                if quality_profile is None:
-                    fail(f"Quality profile not available for this commit")
+                    total_quality_result = asyncio.run(
+                        self._get_total_quality_result_async(oqc_project_names, branch_name, commit_hash))
+                else:
+                    total_quality_result = self._get_total_quality_result(oqc_project_names,
+                                                                          branch_name,
+                                                                          commit_hash)
 
-                quality_result = quality_profile.get('result')
+                run_span.set_attribute('result', total_quality_result)
 
-                self.log_debug(
-                    f"Quality profile result for project '{current_project}': {quality_result}")
+            if total_quality_result:
+                success()
+            else:
+                fail()
+
+        except DeadlineExceededError as error:
+            self._report_project_stages(oqc_project_names)
+            fail(f'{error}')
+        except Exception as error:
+            fail(f'{error}')
+        finally:
+            self._write_metrics()
+            self._save_cassette()
 
-                quality_details = f"The commit for project '{current_project}' "
+    def _create_cassette(self):
+        cassette_file = self.get_variable('OPENQUALITYCHECKER_CASSETTE')
 
-                if quality_result:
-                    quality_details += "is PASSED the analysis"
+        if not cassette_file:
+            return None
 
-                    success(f'{quality_details}', do_exit=False)
-                else:
-                    quality_details += "is FAILED the analysis"
+        mode = self.get_variable('OPENQUALITYCHECKER_CASSETTE_MODE')
+
+        if self._async_mode:
+            self.log_warning('Only the synchronous clients can be recorded and replayed, '
+                             'the OpenQualityChecker requests of the asynchronous mode are sent as usual')
+
+        try:
+            cassette = Cassette(cassette_file, mode, self.get_variable('OPENQUALITYCHECKER_REPLAY_SPEED'))
+        except (OSError, ValueError) as error:
+            fail(f'Could not read cassette {cassette_file}: {error}')
+
+        set_cassette(cassette)
+
+        self.log_info(f'{mode.capitalize()}ing the HTTP requests of this run with cassette {cassette_file}')
+
+        return cassette
+
+    def _save_cassette(self):
+        if self._cassette is None or self._cassette.mode != MODE_RECORD:
+            return
+
+        try:
+            self._cassette.save()
+
+            self.log_debug(f'{len(self._cassette)} requests recorded to {self._cassette.file_name}')
+        except OSError as error:
+            self.log_warning(f'Could not write cassette {self._cassette.file_name}: {error}')
+
+    def _write_metrics(self):
+        metrics_dir = self.get_variable('OPENQUALITYCHECKER_METRICS_DIR')
+
+        if not metrics_dir:
+            return
+
+        try:
+            get_metrics_recorder().write(metrics_dir)
+
+            self.log_debug(f'Run metrics written to {metrics_dir}')
+        except OSError as error:
+            self.log_warning(f'Could not write run metrics to {metrics_dir}: {error}')
+
+    def _report_project_stages(self, oqc_project_names):
+        project_stages = self._openqualitychecker_service.get_project_stages() \
+            if self._openqualitychecker_service else {}
+
+        for current_project in oqc_project_names:
+            self.log_warning(
+                f"[{current_project}] Stage when the time ran out: "
+                f"{project_stages.get(current_project, STAGE_NOT_STARTED)}")
+
+    def _get_total_quality_result(self, oqc_project_names, branch_name, commit_hash):
+        total_quality_result = True
+
+        try:
+            self._openqualitychecker_service.check_availability()
+
+            with closing(self._get_quality_profiles(oqc_project_names,
+                                                    branch_name,
+                                                    commit_hash)) as quality_profiles:
+                for current_project, quality_profile in zip(oqc_project_names, quality_profiles):
+                    quality_result = self._report_quality_result(current_project, quality_profile)
 
-                    reason = _get_failure_reason(quality_profile.get('resultsOfRules'))
+                    total_quality_result = total_quality_result and quality_result
+        finally:
+            self._openqualitychecker_service.close()
 
-                    quality_details += f'\n\tReason: {reason}'
+        return total_quality_result
 
-                    fail(f'{quality_details}', do_exit=False)
+    async def _get_total_quality_result_async(self, oqc_project_names, branch_name, commit_hash):
+        # aiohttp and asyncio are imported only when the asynchronous mode is
+        # used, they make up a large part of the start-up time otherwise
+        import asyncio
+
+        from openqualitychecker_async_service import AsyncOpenQualityCheckerService
+
+        concurrency = self.get_variable('OPENQUALITYCHECKER_WORKERS')
+        openqualitychecker_service = AsyncOpenQualityCheckerService(self, concurrency)
+        self._openqualitychecker_service = openqualitychecker_service
+        semaphore = asyncio.Semaphore(concurrency)
+
+        self.log_debug(f'Evaluating {len(oqc_project_names)} projects on one event loop, '
+                       f'at most {concurrency} at a time')
+
+        async def get_quality_result(current_project):
+            async with semaphore:
+                return await openqualitychecker_service.get_quality_result(current_project,
+                                                                           branch_name,
+                                                                           commit_hash)
+
+        quality_profile_tasks = []
+        total_quality_result = True
+
+        def cancel_on_error(quality_profile_task):
+            if not quality_profile_task.cancelled() and quality_profile_task.exception() is not None:
+                for other_task in quality_profile_tasks:
+                    other_task.cancel()
+
+        try:
+            await openqualitychecker_service.check_availability()
+
+            quality_profile_tasks = [asyncio.ensure_future(get_quality_result(current_project))
+                                     for current_project in oqc_project_names]
+
+            for quality_profile_task in quality_profile_tasks:
+                quality_profile_task.add_done_callback(cancel_on_error)
+
+            for current_project, quality_profile_task in zip(oqc_project_names, quality_profile_tasks):
+                try:
+                    quality_profile = await quality_profile_task
+                except asyncio.CancelledError:
+                    first_error = _get_first_error(quality_profile_tasks)
+
+                    if first_error is None:
+                        raise
+
+                    raise first_error
+
+                quality_result = self._report_quality_result(current_project, quality_profile)
 
                 total_quality_result = total_quality_result and quality_result
+        finally:
+            for quality_profile_task in quality_profile_tasks:
+                quality_profile_task.cancel()
 
-            if total_quality_result:
-                success()
-            else:
-                fail()
+            await asyncio.gather(*quality_profile_tasks, return_exceptions=True)
+            await openqualitychecker_service.close()
 
-        except Exception as error:
-            fail(f'{error}')
+        return total_quality_result
+
+    def _get_quality_profiles(self, oqc_project_names, branch_name, commit_hash):
+        get_quality_result = partial(self._openqualitychecker_service.get_quality_result,
+                                     branch_name=branch_name,
+                                     commit_hash=commit_hash)
+
+        workers = self.get_variable('OPENQUALITYCHECKER_WORKERS')
+
+        if workers <= 1:
+            yield from map(get_quality_result, oqc_project_names)
+            return
+
+        self.log_debug(f'Evaluating {len(oqc_project_names)} projects with {workers} workers')
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        quality_profile_futures = [executor.submit(copy_context().run, get_quality_result, current_project)
+                                   for current_project in oqc_project_names]
+
+        for quality_profile_future in quality_profile_futures:
+            quality_profile_future.add_done_callback(self._cancel_on_error)
+
+        try:
+            for quality_profile_future in quality_profile_futures:
+                try:
+                    yield quality_profile_future.result()
+                except PollingCancelledError as cancelled_error:
+                    raise _get_first_error(quality_profile_futures) or cancelled_error
+        finally:
+            # The projects still waiting for their analysis are not needed
+            # any more once the run has failed or finished
+            for quality_profile_future in quality_profile_futures:
+                quality_profile_future.cancel()
+
+            self._openqualitychecker_service.cancel()
+            executor.shutdown(wait=False)
+
+    def _cancel_on_error(self, quality_profile_future):
+        if not quality_profile_future.cancelled() and quality_profile_future.exception() is not None:
+            self._openqualitychecker_service.cancel()
+
+    def _report_quality_result(self, current_project, quality_profile):
+        if quality_profile is None:
+            fail(f"Quality profile not available for this commit")
+
+        quality_result = quality_profile.get('result')
+
+        self.log_debug(
+            f"Quality profile result for project '{current_project}': {quality_result}")
+
+        quality_details = f"The commit for project '{current_project}' "
+
+        if quality_result:
+            quality_details += "is PASSED the analysis"
+
+            success(f'{quality_details}', do_exit=False)
+        else:
+            quality_details += "is FAILED the analysis"
+
+            reason = _get_failure_reason(quality_profile.get('resultsOfRules'))
+
+            quality_details += f'\n\tReason: {reason}'
+
+            fail(f'{quality_details}', do_exit=False)
+
+        return quality_result
@@ -1,6 +1,11 @@
 import os
 
+from deadline import DEFAULT_TIMEOUT
+from id_cache import DEFAULT_CACHE_TTL
 from oqc_pipe import OpenQualityCheckerPipe
+from polling import DEFAULT_MAX_POLL_INTERVAL, DEFAULT_MIN_POLL_INTERVAL, DEFAULT_POLL_JITTER
+from rate_limiter import DEFAULT_RATE_LIMIT
+from transport import MODE_RECORD, MODE_REPLAY
 
 parameter_schema = {
     'BITBUCKET_USERNAME': {'type': 'string', 'required': False,
@@ -12,12 +17,38 @@ parameter_schema = {
                          'default': os.getenv('BITBUCKET_COMMIT')},
     'BITBUCKET_BRANCH': {'type': 'string', 'required': False,
                          'default': os.getenv('BITBUCKET_BRANCH')},
+    'BITBUCKET_RATE_LIMIT': {'type': 'number', 'required': False, 'default': DEFAULT_RATE_LIMIT, 'min': 0},
     'OPENQUALITYCHECKER_BASE_URL': {'type': 'string', 'required': False,
                                     'default': os.getenv('OPENQUALITYCHECKER_BASE_URL')},
     'OPENQUALITYCHECKER_ACCESS_TOKEN': {'type': 'string', 'required': True,
                                         'default': os.getenv('OPENQUALITYCHECKER_ACCESS_TOKEN')},
     'OPENQUALITYCHECKER_PROJECT_NAME': {'type': 'string', 'required': True,
                                         'default': os.getenv('OPENQUALITYCHECKER_PROJECT_NAME')},
+    'OPENQUALITYCHECKER_WORKERS': {'type': 'integer', 'required': False, 'default': 1, 'min': 1},
+    'OPENQUALITYCHECKER_ASYNC': {'type': 'boolean', 'required': False, 'default': False},
+    'OPENQUALITYCHECKER_CACHE_DIR': {'type': 'string', 'required': False},
+    'OPENQUALITYCHECKER_CACHE_TTL': {'type': 'integer', 'required': False,
+                                     'default': DEFAULT_CACHE_TTL, 'min': 0},
+    'OPENQUALITYCHECKER_TIMEOUT': {'type': 'number', 'required': False,
+                                   'default': DEFAULT_TIMEOUT, 'min': 1},
+    'OPENQUALITYCHECKER_POLL_MIN_INTERVAL': {'type': 'number', 'required': False,
+                                             'default': DEFAULT_MIN_POLL_INTERVAL, 'min': 0},
+    'OPENQUALITYCHECKER_POLL_MAX_INTERVAL': {'type': 'number', 'required': False,
+                                             'default': DEFAULT_MAX_POLL_INTERVAL, 'min': 0},
+    'OPENQUALITYCHECKER_POLL_JITTER': {'type': 'number', 'required': False,
+                                       'default': DEFAULT_POLL_JITTER, 'min': 0, 'max': 1},
+    'OPENQUALITYCHECKER_CALLBACK_PORT': {'type': 'integer', 'required': False, 'min': 0, 'max': 65535},
+    'OPENQUALITYCHECKER_CALLBACK_HOST': {'type': 'string', 'required': False, 'default': '127.0.0.1'},
+    'OPENQUALITYCHECKER_CALLBACK_SECRET': {'type': 'string', 'required': False},
+    'OPENQUALITYCHECKER_RATE_LIMIT': {'type': 'number', 'required': False,
+                                      'default': DEFAULT_RATE_LIMIT, 'min': 0},
+    'OPENQUALITYCHECKER_METRICS_DIR': {'type': 'string', 'required': False, 'nullable': True,
+                                       'default': os.getenv('BITBUCKET_CLONE_DIR')},
+    'OPENQUALITYCHECKER_TRACE_FILE': {'type': 'string', 'required': False},
+    'OPENQUALITYCHECKER_CASSETTE': {'type': 'string', 'required': False},
+    'OPENQUALITYCHECKER_CASSETTE_MODE': {'type': 'string', 'required': False, 'default': MODE_RECORD,
+                                         'allowed': [MODE_RECORD, MODE_REPLAY]},
+    'OPENQUALITYCHECKER_REPLAY_SPEED': {'type': 'number', 'required': False, 'default': 1, 'min': 0},
     'DEBUG': {'type': 'boolean', 'required': False, 'default': False}
 }
 
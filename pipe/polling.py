@@ -0,0 +1,210 @@
+import json
+import os
+import random
+import statistics
+from functools import partial
+from threading import Event, Lock
+
+from bitbucket_pipes_toolkit import Pipe
+
+from atomic_file import write_file_atomically
+from clock import get_clock
+from deadline import Deadline, DeadlineExceededError
+from steps import run_steps, run_steps_async, single_step
+
+HISTORY_FILE_NAME = 'openqualitychecker-durations.json'
+
+# The number of past analysis durations kept per project
+HISTORY_SIZE = 20
+
+DEFAULT_MIN_POLL_INTERVAL = 1
+DEFAULT_MAX_POLL_INTERVAL = 100
+DEFAULT_POLL_JITTER = 0.1
+
+# The growth of the poll interval once the expected analysis time
+# is over or unknown
+POLL_INTERVAL_FACTOR = 1.5
+
+
+class AnalysisDurationHistory:
+
+    def __init__(self, pipe, cache_dir):
+        self._pipe: Pipe = pipe
+        self._history_file = os.path.join(cache_dir, HISTORY_FILE_NAME) if cache_dir else None
+        self._lock = Lock()
+        self._durations = self._load()
+
+    def get_expected_duration(self, oqc_project_name):
+        with self._lock:
+            durations = self._durations.get(oqc_project_name)
+
+            if not durations:
+                return None
+
+            return statistics.median(durations)
+
+    def record(self, oqc_project_name, duration):
+        with self._lock:
+            durations = self._durations.setdefault(oqc_project_name, [])
+            durations.append(round(duration, 3))
+            del durations[:-HISTORY_SIZE]
+
+            self._save()
+
+    def _load(self):
+        if not self._history_file or not os.path.exists(self._history_file):
+            return {}
+
+        try:
+            with open(self._history_file) as history_file:
+                return json.load(history_file).get('durations', {})
+        except (OSError, ValueError, AttributeError) as error:
+            self._pipe.log_warning(f'Ignoring unreadable analysis history {self._history_file}: {error}')
+            return {}
+
+    def _save(self):
+        if not self._history_file:
+            return
+
+        try:
+            write_file_atomically(self._history_file, json.dumps({'durations': self._durations}))
+        except OSError as error:
+            self._pipe.log_warning(f'Could not write analysis history {self._history_file}: {error}')
+
+
+class PollingCancelledError(Exception):
+    pass
+
+
+class PollingScheduler:
+
+    def __init__(self, pipe, history, min_interval=DEFAULT_MIN_POLL_INTERVAL,
+                 max_interval=DEFAULT_MAX_POLL_INTERVAL, jitter=DEFAULT_POLL_JITTER, deadline=None, clock=None):
+        self._pipe: Pipe = pipe
+        self._history: AnalysisDurationHistory = history
+        self._min_interval = min_interval
+        self._max_interval = max(min_interval, max_interval)
+        self._jitter = jitter
+        self._deadline: Deadline = deadline
+        self._clock = clock or get_clock()
+        self._cancel_event = Event()
+        self._wake_events = set()
+        self._wake_events_lock = Lock()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+        # Waits for a completion callback end right away as well
+        with self._wake_events_lock:
+            for wake_event in self._wake_events:
+                wake_event.set()
+
+    def start_waiting(self):
+        return self._clock.monotonic()
+
+    def poll(self, oqc_project_name, operation, waiting_since, wake_event=None):
+        return run_steps(self.poll_steps(oqc_project_name, partial(single_step, operation), waiting_since,
+                                         wake_event))
+
+    async def poll_async(self, oqc_project_name, operation, waiting_since, wake_event=None):
+        return await run_steps_async(self.poll_steps(oqc_project_name, partial(single_step, operation),
+                                                     waiting_since, wake_event, asynchronous=True))
+
+    def poll_steps(self, oqc_project_name, operation_steps, waiting_since, wake_event=None, asynchronous=False):
+        schedule = self._schedule(oqc_project_name, waiting_since, wake_event)
+
+        if wake_event is not None:
+            with self._wake_events_lock:
+                self._wake_events.add(wake_event)
+
+        try:
+            return (yield from self._poll_until_found(oqc_project_name, operation_steps, schedule, wake_event,
+                                                      asynchronous))
+        finally:
+            with self._wake_events_lock:
+                self._wake_events.discard(wake_event)
+
+    def _poll_until_found(self, oqc_project_name, operation_steps, schedule, wake_event, asynchronous):
+        last_error = None
+
+        while True:
+            self._check_cancelled(oqc_project_name)
+
+            try:
+                result = yield from operation_steps()
+
+                if result:
+                    return result
+            except ValueError as value_error:
+                self._pipe.log_debug(f'{value_error}')
+                last_error = value_error
+            except DeadlineExceededError:
+                if last_error is None:
+                    raise
+
+                raise self._deadline.create_error(last_error) from last_error
+
+            interval = next(schedule)
+
+            # The schedule only ends when the deadline has expired
+            if interval is None:
+                raise self._deadline.create_error(last_error) from last_error
+
+            # Without a completion callback, a cancel is the only thing that
+            # ends the wait early
+            event = self._cancel_event if wake_event is None else wake_event
+            woken_up = yield self._wait(interval, event, asynchronous)
+
+            self._check_cancelled(oqc_project_name)
+
+            if woken_up:
+                self._wake_up(oqc_project_name, wake_event)
+
+    def _wait(self, interval, event, asynchronous):
+        return self._clock.wait_async(event, interval) if asynchronous else self._clock.wait(event, interval)
+
+    def _check_cancelled(self, oqc_project_name):
+        if self._cancel_event.is_set():
+            raise PollingCancelledError(f'[{oqc_project_name}] Polling cancelled because another project failed')
+
+    def _schedule(self, oqc_project_name, waiting_since, wake_event):
+        expected_duration = self._history.get_expected_duration(oqc_project_name)
+        polls_after_expected = 0
+
+        while True:
+            waited = self._clock.monotonic() - waiting_since
+
+            if wake_event is not None:
+                interval = self._max_interval
+            elif expected_duration is not None and waited < expected_duration:
+                interval = (expected_duration - waited) / 2
+            else:
+                interval = self._min_interval * POLL_INTERVAL_FACTOR ** polls_after_expected
+                polls_after_expected = polls_after_expected + 1
+
+            interval = min(max(interval, self._min_interval), self._max_interval)
+            interval = interval * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+            if self._deadline is not None:
+                if self._deadline.expired:
+                    yield None
+                    return
+
+                interval = self._deadline.limit(interval)
+
+            self._pipe.log_debug(
+                f"[{oqc_project_name}] Analysis result not available yet, polling again in {interval:.1f} s")
+
+            yield interval
+
+    def _wake_up(self, oqc_project_name, wake_event):
+        wake_event.clear()
+
+        self._pipe.log_debug(f"[{oqc_project_name}] Woken up by an analysis finished callback")
+
+    def record_analysis_duration(self, oqc_project_name, waiting_since):
+        duration = self._clock.monotonic() - waiting_since
+
+        self._pipe.log_debug(f"[{oqc_project_name}] Analysis result was available after {duration:.1f} s")
+
+        self._history.record(oqc_project_name, duration)
@@ -0,0 +1,51 @@
+from bitbucket_pipes_toolkit import Pipe
+
+
+class ProjectIndex:
+
+    def __init__(self, pipe):
+        self._pipe: Pipe = pipe
+        self._project_ids_by_name = {}
+        self._next_page = 1
+        self._total_pages = None
+        self._reloaded = False
+        self.exhausted = False
+
+    def next_pages(self, count):
+        last_page = max(self._total_pages or 0, self._next_page)
+
+        return list(range(self._next_page, min(self._next_page + count - 1, last_page) + 1))
+
+    def get(self, project_name):
+        return self._project_ids_by_name.get(project_name)
+
+    def add_page(self, project_name, page_data):
+        for oqc_project in (page_data or {}).get('content') or []:
+            self._project_ids_by_name.setdefault(oqc_project.get('projectName'), oqc_project.get('id'))
+
+        self._next_page = self._next_page + 1
+        self._total_pages = (page_data or {}).get('totalPages') or self._total_pages
+
+        if page_data and not page_data['last']:
+            return
+
+        self.exhausted = True
+
+        if not self._project_ids_by_name:
+            self._pipe.log_warning(
+                f"[{project_name}] No OpenQualityChecker project is found for the given token")
+
+        self._pipe.log_debug(
+            f"[{project_name}] Loaded {len(self._project_ids_by_name)} OpenQualityChecker project names")
+
+    def reload(self):
+        if self._reloaded:
+            return False
+
+        self._project_ids_by_name = {}
+        self._next_page = 1
+        self._total_pages = None
+        self._reloaded = True
+        self.exhausted = False
+
+        return True
@@ -0,0 +1,196 @@
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+
+from clock import get_clock
+from metrics import get_metrics_recorder, normalize_endpoint
+from tracing import start_span
+
+# The number of requests per second sent to one service by default, 0 sends
+# them without a limit and only waits when the service answers 429
+DEFAULT_RATE_LIMIT = 0
+
+# How many times a request is sent again after a 429 Too Many Requests response
+MAX_RATE_LIMITED_RETRIES = 3
+
+# The wait in seconds after a 429 response without a usable Retry-After header
+DEFAULT_RETRY_AFTER = 1
+
+
+def parse_retry_after(retry_after, clock=None):
+    if not retry_after:
+        return DEFAULT_RETRY_AFTER
+
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    now = datetime.fromtimestamp((clock or get_clock()).time(), timezone.utc)
+
+    return max((retry_at - now).total_seconds(), 0)
+
+
+class RateLimiter:
+
+    def __init__(self, name, rate=DEFAULT_RATE_LIMIT, clock=None):
+        self.name = name
+        self._rate = rate
+        self._clock = clock or get_clock()
+        self._capacity = max(rate or 0, 1)
+        self._tokens = self._capacity
+        self._updated = self._clock.monotonic()
+        self._blocked_until = 0
+        self._lock = Lock()
+        self._throttled_time = 0
+        self._throttled_requests = 0
+        self._rate_limited_responses = 0
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def reserve(self):
+        with self._lock:
+            now = self._clock.monotonic()
+            delay = max(self._blocked_until - now, 0)
+
+            if self._rate:
+                self._tokens = min(self._tokens + (now - self._updated) * self._rate, self._capacity)
+                self._tokens = self._tokens - 1
+                delay = max(delay, -self._tokens / self._rate)
+
+            self._updated = now
+
+            if delay > 0:
+                self._throttled_time += delay
+                self._throttled_requests += 1
+
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+
+        if delay > 0:
+            self._clock.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+
+        if delay > 0:
+            await self._clock.sleep_async(delay)
+
+    def penalize(self, retry_after):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self._clock.monotonic() + retry_after)
+            self._rate_limited_responses += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'throttled_time': self._throttled_time,
+                'throttled_requests': self._throttled_requests,
+                'rate_limited_responses': self._rate_limited_responses
+            }
+
+
+def get_connection_stats(session):
+    connections = 0
+    requests_sent = 0
+
+    for adapter in set(session.adapters.values()):
+        pools = adapter.get_pool_manager().pools
+
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+
+    return {
+        'connections': connections,
+        'requests': requests_sent
+    }
+
+
+class RateLimitedAdapter(HTTPAdapter):
+
+    def __init__(self, rate_limiter, logger, transport=None, **kwargs):
+        self._rate_limiter: RateLimiter = rate_limiter
+        self._logger = logger
+        self._transport = transport
+        self._metrics = get_metrics_recorder()
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        retries = 0
+
+        while True:
+            self._rate_limiter.acquire()
+
+            with start_span('http_request', service=self._rate_limiter.name, method=request.method,
+                            endpoint=normalize_endpoint(urlparse(request.url).path), retries=retries) as span:
+                started = time.monotonic()
+
+                try:
+                    response = self._transport.send(request, **kwargs) if self._transport is not None \
+                        else super().send(request, **kwargs)
+                except Exception:
+                    self._record_request(request, None, started, None, retries)
+                    raise
+
+                span.set_attribute('status', response.status_code)
+
+                if response.status_code != 429 or retries >= MAX_RATE_LIMITED_RETRIES:
+                    self._record_request(request, response, started, self._read_size(response, kwargs), retries)
+                    return response
+
+                self._record_request(request, response, started, None, retries)
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'), self._rate_limiter.clock)
+            retries = retries + 1
+
+            self._logger.warning(
+                f"{self._rate_limiter.name} rate limit reached, sending request again in {retry_after:.1f} s "
+                f"(retry {retries} of {MAX_RATE_LIMITED_RETRIES})")
+
+            self._rate_limiter.penalize(retry_after)
+            response.close()
+
+    def get_pool_manager(self):
+        return self._transport.poolmanager if isinstance(self._transport, HTTPAdapter) else self.poolmanager
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+        super().close()
+
+    def _read_size(self, response, kwargs):
+        if kwargs.get('stream'):
+            return None
+
+        content = response.content
+        wire_size = response.raw.tell() if response.raw is not None else 0
+
+        return wire_size or len(content)
+
+    def _record_request(self, request, response, started, size, retries):
+        self._metrics.record_request(self._rate_limiter.name,
+                                     request.method,
+                                     urlparse(request.url).path,
+                                     response.status_code if response is not None else None,
+                                     time.monotonic() - started,
+                                     size,
+                                     retries)
@@ -0,0 +1,49 @@
+# The lookups and polls of a project are written once as generators that
+# yield the result of every API call and wait. The synchronous clients return
+# the result itself, which is sent straight back, while the asynchronous ones
+# return an awaitable, which is awaited first. This way only the I/O differs
+# between the two modes.
+
+
+def single_step(operation):
+    return (yield operation())
+
+
+# Holds the lock while the steps run. The lock is created by the service to
+# fit its mode: acquiring a threading.Lock blocks and returns True, acquiring
+# an asyncio.Lock returns a coroutine, so either way the acquire is a step.
+def with_lock(lock, steps):
+    yield lock.acquire()
+
+    try:
+        return (yield from steps)
+    finally:
+        lock.release()
+
+
+def run_steps(steps):
+    value = None
+
+    while True:
+        try:
+            value = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+
+
+async def run_steps_async(steps):
+    value = None
+    error = None
+
+    while True:
+        try:
+            awaitable = steps.send(value) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+
+        try:
+            value = await awaitable
+            error = None
+        except BaseException as exception:
+            value = None
+            error = exception
@@ -1,12 +1,47 @@
+import asyncio
+import json
 import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from email.utils import formatdate
+from urllib.parse import parse_qs, urlparse
 
 import pytest
-
+import requests
+from bitbucket_pipes_toolkit import Pipe
+from requests.adapters import BaseAdapter
+
+import bitbucket_api
+import openqualitychecker_api
+from bitbucket_api import BitbucketApi
+from circuit_breaker import CircuitBreaker, ServiceUnavailableError
+from clock import SimulatedClock, get_clock, set_clock
+from completion_listener import CALLBACK_PATH, CALLBACK_SECRET_HEADER, CompletionListener
+from deadline import Deadline, DeadlineExceededError
+from id_cache import CACHE_FILE_NAME, IdCache
+from metrics import LATENCY_BUCKETS, PROMETHEUS_FILE_NAME, SUMMARY_FILE_NAME, MetricsRecorder
+from openqualitychecker_api import OpenQualityCheckerApi
 from oqc_pipe import OpenQualityCheckerPipe
 from pipe import parameter_schema
+from polling import HISTORY_FILE_NAME, AnalysisDurationHistory, PollingScheduler
+from rate_limiter import DEFAULT_RETRY_AFTER, RateLimitedAdapter, RateLimiter, parse_retry_after
+from tracing import InMemoryExporter, set_exporter, start_span
+from transport import MODE_REPLAY, Cassette, ReplayAdapter
+from openqualitychecker_service import OpenQualityCheckerService
+from version_tracker import VersionTracker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'benchmark'))
+
+from fake_openqualitychecker import BRANCH_NAME, COMMIT_HASH, FakeOpenQualityChecker, project_name  # noqa: E402
 
 OPENQUALITYCHECKER_BASE_URL = 'http://localhost:3031/backend'
 
+CALLBACK_SECRET = 'callback-secret'
+
 
 def test_no_parameters(capsys):
     result, wrapped_error = run_the_pipe(capsys)
@@ -98,7 +133,7 @@ def test_not_existing_branch(capsys):
     assert_output(result, "Branch not found: 'not-existing-branch'")
 
 
-def test_not_existing_version(capsys):
+def test_not_existing_version(capsys, simulated_clock):
     os.environ["OPENQUALITYCHECKER_BASE_URL"] = f"{OPENQUALITYCHECKER_BASE_URL}"
     os.environ["BITBUCKET_USERNAME"] = f"dummy_user"
     os.environ["BITBUCKET_PASSWORD"] = f"dummy_password"
@@ -118,7 +153,7 @@ def test_not_existing_version(capsys):
                   "Version not found for branch id: '285' and hash: 'not-existing-version-commit-hash'")
 
 
-def test_not_existing_quality_profile(capsys):
+def test_not_existing_quality_profile(capsys, simulated_clock):
     os.environ["OPENQUALITYCHECKER_BASE_URL"] = f"{OPENQUALITYCHECKER_BASE_URL}"
     os.environ["BITBUCKET_USERNAME"] = f"dummy_user"
     os.environ["BITBUCKET_PASSWORD"] = f"dummy_password"
@@ -217,6 +252,30 @@ def test_partial_failed_projects(capsys):
     assert_output(result, 'Fail')
 
 
+def test_partial_failed_projects_concurrently(capsys, monkeypatch):
+    os.environ["OPENQUALITYCHECKER_BASE_URL"] = f"{OPENQUALITYCHECKER_BASE_URL}"
+    os.environ["BITBUCKET_USERNAME"] = f"dummy_user"
+    os.environ["BITBUCKET_PASSWORD"] = f"dummy_password"
+    os.environ["BITBUCKET_REPOSITORY"] = f"dummy_repository"
+    os.environ["BITBUCKET_BRANCH"] = f"master"
+    os.environ["BITBUCKET_COMMIT"] = f"failed-quality-commit-hash"
+    os.environ["OPENQUALITYCHECKER_ACCESS_TOKEN"] = f"oqc_token"
+    os.environ[
+        "OPENQUALITYCHECKER_PROJECT_NAME"] = f"process-metrics, Qualityprofiletest, analyzer-client"
+    os.environ["DEBUG"] = f"True"
+    monkeypatch.setenv("OPENQUALITYCHECKER_WORKERS", "3")
+
+    result, wrapped_error = run_the_pipe(capsys)
+
+    print(f'\n{result.out}')
+
+    assert_exit_code(wrapped_error, 1)
+    assert result.out.index("The commit for project 'process-metrics' is FAILED the analysis") \
+           < result.out.index("The commit for project 'Qualityprofiletest' is FAILED the analysis") \
+           < result.out.index("The commit for project 'analyzer-client' is PASSED the analysis")
+    assert_output(result, 'Fail')
+
+
 def test_passed_project(capsys):
     os.environ["OPENQUALITYCHECKER_BASE_URL"] = f"{OPENQUALITYCHECKER_BASE_URL}"
     os.environ["BITBUCKET_USERNAME"] = f"dummy_user"
@@ -258,6 +317,822 @@ def test_passed_projects(capsys):
     assert_output(result, 'Success')
 
 
+def test_completion_callback_ends_polling():
+    pipe = Pipe(schema={})
+    listener = CompletionListener(pipe, '127.0.0.1', 0, CALLBACK_SECRET)
+    listener.start()
+
+    scheduler = PollingScheduler(pipe, AnalysisDurationHistory(pipe, None),
+                                 min_interval=60, max_interval=60, jitter=0, deadline=Deadline(600))
+    wake_event = listener.get_event('process-metrics', 'callback-commit-hash')
+    polls = []
+
+    def get_quality_profile():
+        polls.append(time.monotonic())
+
+        if len(polls) == 1:
+            threading.Timer(0.2, notify_analysis_finished,
+                            args=(listener.port, 'callback-commit-hash', 'process-metrics')).start()
+            return None
+
+        return {'result': True}
+
+    try:
+        quality_profile = scheduler.poll('process-metrics', get_quality_profile,
+                                         scheduler.start_waiting(), wake_event)
+    finally:
+        listener.stop()
+
+    assert quality_profile == {'result': True}
+    assert len(polls) == 2
+    assert polls[1] - polls[0] < 30
+
+
+def test_simulated_clock_replays_an_hour_long_wait():
+    clock = SimulatedClock()
+    scheduler = PollingScheduler(Pipe(schema={}), AnalysisDurationHistory(Pipe(schema={}), None),
+                                 min_interval=1, max_interval=100, jitter=0, deadline=Deadline(3600, clock),
+                                 clock=clock)
+    polls = []
+
+    def get_quality_profile():
+        polls.append(clock.monotonic())
+
+        return {'result': True} if clock.monotonic() >= 3000 else None
+
+    started = time.monotonic()
+    quality_profile = scheduler.poll('process-metrics', get_quality_profile, scheduler.start_waiting())
+
+    assert quality_profile == {'result': True}
+    assert polls[-1] >= 3000
+    assert len(polls) == clock.sleep_count + 1
+    assert polls[1:] == sorted(polls[1:])
+    assert max(second - first for first, second in zip(polls, polls[1:])) <= 100
+
+    with pytest.raises(DeadlineExceededError):
+        scheduler.poll('process-metrics', lambda: None, scheduler.start_waiting())
+
+    def get_missing_version():
+        raise ValueError('Version not found')
+
+    with pytest.raises(DeadlineExceededError, match='last error: Version not found') as error_info:
+        scheduler.poll('process-metrics', get_missing_version, scheduler.start_waiting())
+
+    assert isinstance(error_info.value.__cause__, ValueError)
+    assert clock.monotonic() == 3600
+    assert time.monotonic() - started < 1
+
+
+def test_analysis_duration_history_sets_the_first_poll_interval(tmp_path):
+    with open(tmp_path / HISTORY_FILE_NAME, 'w') as history_file:
+        json.dump({'durations': {'process-metrics': [40, 60, 50], 'slow-project': [1000], 'fast-project': [2]}},
+                  history_file)
+
+    clock = SimulatedClock()
+    pipe = Pipe(schema={})
+    scheduler = PollingScheduler(pipe, AnalysisDurationHistory(pipe, str(tmp_path)),
+                                 min_interval=5, max_interval=100, jitter=0, deadline=Deadline(3600, clock),
+                                 clock=clock)
+
+    def poll_twice(oqc_project_name):
+        polls = []
+
+        def get_quality_profile():
+            polls.append(clock.monotonic())
+
+            return {'result': True} if len(polls) == 2 else None
+
+        waiting_since = scheduler.start_waiting()
+        scheduler.poll(oqc_project_name, get_quality_profile, waiting_since)
+        scheduler.record_analysis_duration(oqc_project_name, waiting_since)
+
+        return polls[1] - polls[0]
+
+    assert poll_twice('process-metrics') == 25
+    assert poll_twice('slow-project') == 100
+    assert poll_twice('fast-project') == 5
+
+    with open(tmp_path / HISTORY_FILE_NAME) as history_file:
+        assert json.load(history_file)['durations'] == {'process-metrics': [40, 60, 50, 25],
+                                                        'slow-project': [1000, 100],
+                                                        'fast-project': [2, 5]}
+
+
+def test_simulated_clock_does_not_add_up_concurrent_sleeps():
+    clock = SimulatedClock()
+    barrier = threading.Barrier(3)
+    wake_up_times = []
+
+    def poll():
+        clock.monotonic()
+        barrier.wait()
+
+        clock.sleep(10)
+        clock.wait(threading.Event(), 5)
+        wake_up_times.append(clock.monotonic())
+
+    workers = [threading.Thread(target=poll) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert wake_up_times == [15, 15, 15]
+    assert clock.monotonic() == 15
+    assert clock.sleep_count == 6
+
+
+def test_id_cache_expires_entries_on_the_clock(tmp_path):
+    clock = SimulatedClock(epoch=1000000)
+    id_cache = IdCache(Pipe(schema={}), str(tmp_path), ttl=60, scope='test', clock=clock)
+
+    id_cache.put(('project', 'process-metrics'), 1)
+    clock.advance(60)
+
+    assert id_cache.get(('project', 'process-metrics')) == 1
+
+    clock.advance(1)
+
+    assert id_cache.get(('project', 'process-metrics')) is None
+
+
+def test_rate_limiter_shared_by_workers_honours_retry_after():
+    rate_limiter = RateLimiter('test', rate=20)
+
+    def send_requests():
+        for _ in range(10):
+            rate_limiter.acquire()
+
+    started = time.monotonic()
+
+    workers = [threading.Thread(target=send_requests) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert time.monotonic() - started >= 0.4
+    assert rate_limiter.get_stats()['throttled_requests'] >= 10
+
+    rate_limiter.penalize(0.5)
+
+    assert rate_limiter.reserve() >= 0.4
+    assert rate_limiter.get_stats()['rate_limited_responses'] == 1
+
+
+def test_retry_after_http_date_is_measured_on_the_clock():
+    clock = SimulatedClock(epoch=1000000)
+
+    assert parse_retry_after(formatdate(1000030, usegmt=True), clock) == 30
+    assert parse_retry_after(formatdate(999990, usegmt=True), clock) == 0
+    assert parse_retry_after('2.5', clock) == 2.5
+    assert parse_retry_after('not-a-date', clock) == DEFAULT_RETRY_AFTER
+
+
+def test_circuit_breaker_opens_after_consecutive_connection_failures():
+    circuit_breaker = CircuitBreaker('OpenQualityChecker', failure_threshold=3)
+
+    circuit_breaker.record_failure(ConnectionError('refused'))
+    circuit_breaker.record_success()
+    circuit_breaker.record_failure(ConnectionError('refused'))
+    circuit_breaker.record_failure(ConnectionError('refused'))
+
+    circuit_breaker.check()
+
+    with pytest.raises(ServiceUnavailableError, match='OpenQualityChecker not available'):
+        circuit_breaker.record_failure(ConnectionError('refused'))
+
+    with pytest.raises(ServiceUnavailableError):
+        circuit_breaker.check()
+
+
+def test_circuit_breaker_closes_after_a_successful_trial_request():
+    clock = SimulatedClock()
+    circuit_breaker = CircuitBreaker('OpenQualityChecker', failure_threshold=2, cool_down=30, clock=clock)
+
+    circuit_breaker.record_failure(ConnectionError('refused'))
+
+    with pytest.raises(ServiceUnavailableError):
+        circuit_breaker.record_failure(ConnectionError('refused'))
+
+    clock.advance(29)
+
+    with pytest.raises(ServiceUnavailableError):
+        circuit_breaker.check()
+
+    clock.advance(1)
+    circuit_breaker.check()
+
+    with pytest.raises(ServiceUnavailableError):
+        circuit_breaker.check()
+
+    with pytest.raises(ServiceUnavailableError):
+        circuit_breaker.record_failure(ConnectionError('refused'))
+
+    clock.advance(30)
+    circuit_breaker.check()
+    circuit_breaker.record_success()
+
+    assert not circuit_breaker.is_open
+
+    circuit_breaker.check()
+    circuit_breaker.record_failure(ConnectionError('refused'))
+    circuit_breaker.check()
+
+
+def test_version_tracker_finds_the_commit_in_changing_version_lists():
+    versions = [{'id': version_id, 'hash': f'commit-hash-{version_id}'} for version_id in range(1000)]
+    new_version = {'id': 1000, 'hash': 'new-commit-hash'}
+
+    version_tracker = VersionTracker()
+
+    assert version_tracker.find_version_id(285, versions, 'new-commit-hash') is None
+    assert version_tracker.find_version_id(285, versions + [new_version], 'new-commit-hash') == 1000
+
+    version_tracker = VersionTracker()
+
+    assert version_tracker.find_version_id(285, list(reversed(versions)), 'new-commit-hash') is None
+    assert version_tracker.find_version_id(285, [new_version] + list(reversed(versions)), 'new-commit-hash') == 1000
+
+    version_tracker = VersionTracker()
+    unchanged_versions = versions + [new_version]
+
+    assert version_tracker.find_version_id(285, versions, 'new-commit-hash') is None
+    assert version_tracker.find_version_id(285, versions, 'new-commit-hash') is None
+    assert version_tracker.find_version_id(285, unchanged_versions, 'new-commit-hash') == 1000
+    assert version_tracker.find_version_id(285, unchanged_versions, 'new-commit-hash') == 1000
+
+    version_tracker = VersionTracker()
+    reordered_versions = versions[500:] + [new_version] + versions[:500]
+
+    assert version_tracker.find_version_id(285, versions, 'new-commit-hash') is None
+    assert version_tracker.find_version_id(285, reordered_versions, 'new-commit-hash') == 1000
+    assert version_tracker.find_version_id(285, versions[:10] + [new_version], 'commit-hash-5') == 5
+    assert version_tracker.find_version_id(286, versions, 'new-commit-hash') is None
+
+
+def test_metrics_summary_and_prometheus_textfile(tmp_path):
+    metrics = MetricsRecorder()
+
+    metrics.record_request('OpenQualityChecker', 'GET', '/backend/api/branch/285/versions', 200, 0.2, 512, 0)
+    metrics.record_request('OpenQualityChecker', 'GET', '/backend/api/branch/289/versions', 429, 0.01, None, 1)
+
+    with metrics.time_stage('find_version_id', 'process-metrics'):
+        pass
+
+    metrics.record_stage('find_quality_profile', 'process-metrics', 1200)
+    metrics.record_decoding('OpenQualityChecker', '/backend/api/project/285/branches', 2048, 0.002)
+    metrics.record_decoding('OpenQualityChecker', '/backend/api/project/289/branches', 1024, 0.001)
+
+    metrics.write(str(tmp_path))
+
+    with open(tmp_path / SUMMARY_FILE_NAME) as summary_file:
+        summary = json.load(summary_file)
+
+    assert summary['requests'][0]['endpoint'] == '/backend/api/branch/{id}/versions'
+    assert summary['requests'][0]['count'] == 2
+    assert summary['requests'][0]['statuses'] == {'200': 1, '429': 1}
+    assert summary['stages'][0]['stage'] == 'find_version_id'
+    assert list(summary['requests'][0]['buckets']) == [f'{bucket}' for bucket in LATENCY_BUCKETS]
+    assert summary['stages'][1]['buckets'] == {'1': 0, '5': 0, '30': 0, '60': 0, '300': 0, '900': 0, '1800': 1,
+                                               '3600': 1}
+    assert summary['decoding'][0]['endpoint'] == '/backend/api/project/{id}/branches'
+    assert summary['decoding'][0]['count'] == 2
+    assert summary['decoding'][0]['bytes'] == 3072
+
+    prometheus_text = (tmp_path / PROMETHEUS_FILE_NAME).read_text()
+
+    assert 'openqualitychecker_pipe_http_requests_total{service="OpenQualityChecker",method="GET",' \
+           'endpoint="/backend/api/branch/{id}/versions",status="429"} 1' in prometheus_text
+    assert 'openqualitychecker_pipe_stage_duration_seconds_count{stage="find_version_id",' \
+           'project="process-metrics"} 1' in prometheus_text
+    assert 'openqualitychecker_pipe_stage_duration_seconds_bucket{stage="find_quality_profile",' \
+           'project="process-metrics",le="1800"} 1' in prometheus_text
+
+
+def test_tracing_spans_nest_across_worker_threads():
+    exporter = InMemoryExporter()
+    set_exporter(exporter)
+
+    def find_version_id():
+        with start_span('find_version_id', project='process-metrics'):
+            with start_span('http_request', endpoint='/backend/api/branch/{id}/versions'):
+                pass
+
+    try:
+        with start_span('run') as run_span:
+            with start_span('project', project='process-metrics') as project_span:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    executor.submit(copy_context().run, find_version_id).result()
+
+        with pytest.raises(ValueError):
+            with start_span('run'):
+                raise ValueError('Version not found')
+    finally:
+        set_exporter(None)
+
+    spans_by_name = {span.name: span for span in exporter.spans[:4]}
+
+    assert [span.name for span in exporter.spans[:4]] == ['http_request', 'find_version_id', 'project', 'run']
+    assert spans_by_name['http_request'].parent_id == spans_by_name['find_version_id'].span_id
+    assert spans_by_name['find_version_id'].parent_id == project_span.span_id
+    assert project_span.parent_id == run_span.span_id
+    assert {span.trace_id for span in exporter.spans[:4]} == {run_span.trace_id}
+    assert exporter.spans[4].error == 'ValueError: Version not found'
+
+
+@pytest.mark.parametrize('async_mode', ['false', 'true'])
+def test_pipe_run_spans_nest_from_the_run_down_to_the_http_requests(capsys, fake_openqualitychecker, monkeypatch,
+                                                                    async_mode):
+    if async_mode == 'true':
+        pytest.importorskip('aiohttp')
+
+    monkeypatch.setenv('OPENQUALITYCHECKER_ASYNC', async_mode)
+    exporter = InMemoryExporter()
+    set_exporter(exporter)
+
+    try:
+        run_the_pipe(capsys)
+    finally:
+        set_exporter(None)
+
+    spans_by_id = {span.span_id: span for span in exporter.spans}
+    run_span, = [span for span in exporter.spans if span.name == 'run']
+    project_span, = [span for span in exporter.spans if span.name == 'project']
+    stage_spans = [span for span in exporter.spans if span.parent_id == project_span.span_id]
+    request_spans = [span for span in exporter.spans if span.name == 'http_request']
+
+    assert run_span.parent_id is None
+    assert project_span.parent_id == run_span.span_id
+    assert [span.name for span in stage_spans] == ['find_project_id_by_name', 'find_branch_id', 'find_version_id',
+                                                   'find_quality_profile']
+    assert [spans_by_id[span.parent_id].name for span in request_spans] == [
+        'run', 'find_project_id_by_name', 'find_branch_id', 'find_version_id', 'find_quality_profile']
+    assert request_spans[0].attributes['status'] == 200
+    assert {span.trace_id for span in exporter.spans} == {run_span.trace_id}
+
+
+def test_completion_callback_without_the_secret_is_rejected():
+    listener = CompletionListener(Pipe(schema={}), '127.0.0.1', 0, CALLBACK_SECRET)
+    listener.start()
+
+    wake_event = listener.get_event('process-metrics', 'callback-commit-hash')
+    callback_url = f'http://127.0.0.1:{listener.port}{CALLBACK_PATH}'
+    callback = {'hash': 'callback-commit-hash', 'project': 'process-metrics'}
+
+    try:
+        responses = [requests.post(callback_url, json=callback),
+                     requests.post(callback_url, json=callback, headers={CALLBACK_SECRET_HEADER: 'wrong-secret'})]
+    finally:
+        listener.stop()
+
+    assert [response.status_code for response in responses] == [401, 401]
+    assert not wake_event.is_set()
+
+
+def test_callback_port_without_a_secret_fails_the_pipe(capsys, fake_openqualitychecker, monkeypatch):
+    monkeypatch.setenv('OPENQUALITYCHECKER_CALLBACK_PORT', '0')
+    monkeypatch.delenv('OPENQUALITYCHECKER_CALLBACK_SECRET', raising=False)
+
+    result, wrapped_error = run_the_pipe(capsys)
+
+    assert_exit_code(wrapped_error, 1)
+    assert_output(result, 'OPENQUALITYCHECKER_CALLBACK_SECRET is required')
+
+
+def notify_analysis_finished(port, commit_hash, oqc_project_name):
+    response = requests.post(f'http://127.0.0.1:{port}{CALLBACK_PATH}',
+                             json={'hash': commit_hash, 'project': oqc_project_name},
+                             headers={CALLBACK_SECRET_HEADER: CALLBACK_SECRET})
+    response.raise_for_status()
+
+
+def test_cassette_replays_recorded_responses_with_scaled_timing(tmp_path):
+    cassette_file = str(tmp_path / 'cassette.json.gz')
+    url = f'{OPENQUALITYCHECKER_BASE_URL}/api/branch/285/versions'
+    recording_clock = SimulatedClock()
+    recording = Cassette(cassette_file, clock=recording_clock)
+
+    for sent_at, status, body in ((0, 200, b'{"data": [{"id": 1}]}'), (8, 304, b'')):
+        response = requests.Response()
+        response.status_code = status
+        response.headers['ETag'] = '"versions"'
+        response._content = body
+        recording_clock.advance(sent_at + 2 - recording_clock.monotonic())
+        recording.record(requests.Request('GET', url).prepare(), response, 2)
+
+    recording.save()
+
+    clock = SimulatedClock()
+    session = requests.Session()
+    session.mount('http://', RateLimitedAdapter(RateLimiter('test', rate=None), Pipe(schema={}).logger,
+                                                transport=ReplayAdapter(Cassette(cassette_file, MODE_REPLAY, 4,
+                                                                                 clock))))
+    responses = []
+    answered_at = []
+
+    for _ in range(3):
+        responses.append(session.get(url))
+        answered_at.append(clock.monotonic())
+
+    assert [response.status_code for response in responses] == [200, 304, 304]
+    assert responses[0].json() == {'data': [{'id': 1}]}
+    assert responses[1].headers['ETag'] == '"versions"'
+    assert answered_at == [0.5, 2.5, 3.0]
+
+    with pytest.raises(requests.ConnectionError):
+        session.get(f'{OPENQUALITYCHECKER_BASE_URL}/api/projects')
+
+
+def test_bitbucket_annotations_are_uploaded_in_batches(bitbucket_repository):
+    transport = FakeBitbucketTransport()
+    bitbucket = BitbucketApi(RateLimiter('test'), transport)
+
+    batch_results = bitbucket.annotate_bulk([create_finding(index) for index in range(250)], 'commit-hash',
+                                            'report-id')
+
+    assert [batch_result['size'] for batch_result in batch_results] == [100, 100, 50]
+    assert sorted(len(batch) for batch in transport.uploaded_batches) == [50, 100, 100]
+    assert len(transport.annotations) == 250
+
+    bitbucket.annotate('src/Main.java', 12, 'commit-hash', 'report-id', 'process-metrics', 'rule-1')
+    bitbucket.annotate('src/Main.java', 12, 'commit-hash', 'report-id', 'process-metrics', 'rule-2')
+
+    assert len(transport.annotations) == 252
+
+
+def test_bitbucket_annotation_sync_deletes_stale_annotations_and_reports_failed_batches(bitbucket_repository,
+                                                                                       monkeypatch):
+    monkeypatch.setattr(bitbucket_api, 'MAX_ANNOTATION_DELETES', 2)
+
+    findings = [create_finding(index) for index in range(153)]
+    stale_annotations = [create_finding(index) for index in range(1000, 1003)]
+    transport = FakeBitbucketTransport(annotations=findings[:3] + stale_annotations,
+                                       failing_external_id=findings[150]['external_id'],
+                                       rate_limited_deletes=1)
+    rate_limiter = RateLimiter('test')
+    bitbucket = BitbucketApi(rate_limiter, transport)
+
+    result = bitbucket.sync_annotations(findings, 'commit-hash', 'report-id')
+
+    assert result['uploaded'] == 150
+    assert result['unchanged'] == 3
+    assert result['deleted'] == 2
+    assert len(result['errors']) == 1
+    assert len(transport.annotations) == 3 + 1 + 100
+    assert transport.count_requests('GET') == 3
+    assert transport.count_requests('DELETE') == 3
+    assert rate_limiter.get_stats()['rate_limited_responses'] == 1
+
+
+def test_bitbucket_annotations_without_external_id_get_deterministic_ids(bitbucket_repository):
+    findings = [dict(create_finding(index), external_id=None, project='process-metrics', rule=f'rule-{index % 3}')
+                for index in range(5)]
+    transport = FakeBitbucketTransport()
+    bitbucket = BitbucketApi(RateLimiter('test'), transport)
+
+    assert bitbucket.sync_annotations(findings, 'commit-hash', 'report-id')['uploaded'] == 5
+    assert bitbucket.sync_annotations(findings, 'commit-hash', 'report-id') == {
+        'uploaded': 0, 'deleted': 0, 'unchanged': 5, 'errors': []}
+    assert transport.count_requests('POST') == 1
+    assert transport.count_requests('DELETE') == 0
+
+    findings_of_other_rules = [dict(findings[0], rule=rule) for rule in ('rule-0', 'rule-1', 'rule-2')]
+
+    assert bitbucket.sync_annotations(findings_of_other_rules, 'commit-hash', 'report-id') == {
+        'uploaded': 2, 'deleted': 4, 'unchanged': 1, 'errors': []}
+    assert len(transport.annotations) == 3
+
+
+def test_bitbucket_report_is_found_on_a_later_page_and_reused(bitbucket_repository):
+    transport = FakeBitbucketTransport(reports=[{'external_id': f'other-report-{index}'} for index in range(3)] +
+                                       [{'external_id': 'openqualitychecker-warning-report-commit-hash',
+                                         'uuid': '{existing-report}'}])
+    bitbucket = BitbucketApi(RateLimiter('test'), transport)
+
+    assert bitbucket.get_or_create_report('commit-hash')['uuid'] == '{existing-report}'
+    assert bitbucket.get_or_create_report('commit-hash')['uuid'] == '{existing-report}'
+    assert transport.count_requests('GET') == 2
+    assert transport.count_requests('PUT') == 0
+
+    assert bitbucket.get_or_create_report('other-commit-hash')['uuid'] == '{created-report}'
+    assert transport.count_requests('PUT') == 1
+
+
+def test_pipe_entry_point_defers_optional_imports():
+    deferred_modules = ('aiohttp', 'asyncio', 'http.server', 'openqualitychecker_async_service')
+    result = subprocess.run(
+        [sys.executable, '-c', f'import pipe, sys; print([m for m in {deferred_modules!r} if m in sys.modules])'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), check=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+    assert result.stdout.strip() == '[]'
+
+
+def test_async_service_sends_the_same_requests_as_the_sync_service(fake_openqualitychecker):
+    pytest.importorskip('aiohttp')
+    from openqualitychecker_async_service import AsyncOpenQualityCheckerService
+
+    pipe = Pipe(schema=parameter_schema)
+    oqc_project_names = [project_name(project_id) for project_id in (3, 17, 30)]
+
+    service = OpenQualityCheckerService(pipe)
+    try:
+        results = [service.get_quality_result(oqc_project_name, BRANCH_NAME, COMMIT_HASH)
+                   for oqc_project_name in oqc_project_names]
+    finally:
+        service.close()
+
+    sync_requests = dict(fake_openqualitychecker.requests)
+    fake_openqualitychecker.requests.clear()
+
+    async def get_quality_results():
+        async_service = AsyncOpenQualityCheckerService(pipe, 2)
+        try:
+            return [await async_service.get_quality_result(oqc_project_name, BRANCH_NAME, COMMIT_HASH)
+                    for oqc_project_name in oqc_project_names]
+        finally:
+            await async_service.close()
+
+    assert asyncio.run(get_quality_results()) == results
+    assert fake_openqualitychecker.requests == sync_requests
+    assert all(result['resultsOfRules'] for result in results)
+
+
+def test_async_service_retries_rate_limited_requests_and_reports_errors(fake_openqualitychecker):
+    pytest.importorskip('aiohttp')
+    from openqualitychecker_async_service import AsyncOpenQualityCheckerService
+
+    fake_openqualitychecker.rate_limited_requests = 2
+
+    async def get_quality_result(oqc_project_name):
+        async_service = AsyncOpenQualityCheckerService(Pipe(schema=parameter_schema), 2)
+        try:
+            return await async_service.get_quality_result(oqc_project_name, BRANCH_NAME, COMMIT_HASH)
+        finally:
+            await async_service.close()
+
+    assert asyncio.run(get_quality_result(project_name(1)))['resultsOfRules']
+    assert fake_openqualitychecker.requests['rate_limited'] == 2
+
+    with pytest.raises(ValueError, match='Project id NOT found'):
+        asyncio.run(get_quality_result('unknown-project'))
+
+    fake_openqualitychecker.token = 'another-token'
+
+    with pytest.raises(ValueError, match='Request not authorized'):
+        asyncio.run(get_quality_result(project_name(1)))
+
+
+def test_unchanged_version_list_is_answered_with_not_modified(fake_openqualitychecker, monkeypatch):
+    metrics = MetricsRecorder()
+    monkeypatch.setattr('metrics._metrics_recorder', metrics)
+
+    api = OpenQualityCheckerApi(Pipe(schema=parameter_schema))
+    try:
+        versions = api.get_version(1)
+        bytes_sent = fake_openqualitychecker.bytes_sent
+
+        assert api.get_version(1) == versions
+    finally:
+        api.close()
+
+    assert versions
+    assert fake_openqualitychecker.requests['versions'] == 2
+    assert fake_openqualitychecker.bytes_sent == bytes_sent
+    assert metrics.get_summary()['requests'][0]['statuses'] == {'200': 1, '304': 1}
+    assert api._bytes_saved > 0
+
+
+def test_openqualitychecker_requests_reuse_keep_alive_connections(fake_openqualitychecker):
+    api = OpenQualityCheckerApi(Pipe(schema=parameter_schema))
+    try:
+        for project_id in range(1, 6):
+            assert api.get_branches(project_id)
+
+        stats = api.get_connection_stats()
+    finally:
+        api.close()
+
+    assert stats['requests'] == fake_openqualitychecker.request_count == 5
+    assert stats['connections'] < stats['requests']
+
+
+def test_project_listing_stops_at_the_page_of_the_project_and_reloads_on_a_miss(fake_openqualitychecker,
+                                                                               monkeypatch):
+    monkeypatch.setattr(openqualitychecker_api, 'PROJECT_PAGE_SIZE', 5)
+
+    service = OpenQualityCheckerService(Pipe(schema=parameter_schema))
+
+    def get_quality_result(oqc_project_name):
+        return service.get_quality_result(oqc_project_name, BRANCH_NAME, COMMIT_HASH)
+
+    try:
+        assert get_quality_result(project_name(3))['resultsOfRules']
+        assert fake_openqualitychecker.requests['projects'] == 1
+
+        assert get_quality_result(project_name(12))['resultsOfRules']
+        assert fake_openqualitychecker.requests['projects'] == 5
+
+        assert get_quality_result(project_name(28))['resultsOfRules']
+        assert fake_openqualitychecker.requests['projects'] == 6
+
+        fake_openqualitychecker.projects = 31
+
+        assert get_quality_result(project_name(31))['resultsOfRules']
+        assert fake_openqualitychecker.requests['projects'] == 6 + 7
+
+        with pytest.raises(ValueError, match='Project id NOT found'):
+            get_quality_result('unknown-project')
+
+        assert fake_openqualitychecker.requests['projects'] == 6 + 7
+    finally:
+        service.close()
+
+
+def test_timed_out_run_keeps_the_valid_cached_project_id(capsys, simulated_clock, fake_openqualitychecker,
+                                                        monkeypatch, tmp_path):
+    monkeypatch.setenv('OPENQUALITYCHECKER_CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('OPENQUALITYCHECKER_TIMEOUT', '600')
+    monkeypatch.setenv('BITBUCKET_COMMIT', 'not-analyzed-commit-hash')
+
+    result, wrapped_error = run_the_pipe(capsys)
+
+    assert_exit_code(wrapped_error, 1)
+    assert_output(result, f'did not finish within 600 s, last error: [{project_name(1)}] Version not found')
+
+    with open(tmp_path / CACHE_FILE_NAME) as cache_file:
+        assert [entry['id'] for entry in json.load(cache_file)['entries'].values()] == [1]
+
+
+def test_stale_cached_project_id_is_searched_again_before_polling(fake_openqualitychecker, monkeypatch, tmp_path):
+    monkeypatch.setenv('OPENQUALITYCHECKER_CACHE_DIR', str(tmp_path))
+    pipe = Pipe(schema=parameter_schema)
+    cache_scope = f'{fake_openqualitychecker.base_url}|{fake_openqualitychecker.token}'
+
+    IdCache(pipe, str(tmp_path), 3600, cache_scope).put(('project', project_name(1)), 999)
+
+    service = OpenQualityCheckerService(pipe)
+    try:
+        quality_profile = service.get_quality_result(project_name(1), BRANCH_NAME, COMMIT_HASH)
+    finally:
+        service.close()
+
+    assert quality_profile['resultsOfRules']
+    assert fake_openqualitychecker.requests['other'] == 1
+    assert fake_openqualitychecker.requests['projects'] == 1
+    assert fake_openqualitychecker.requests['branches'] == 1
+    assert fake_openqualitychecker.requests['versions'] == 1
+    assert IdCache(pipe, str(tmp_path), 3600, cache_scope).get(('project', project_name(1))) == 1
+
+
+@pytest.mark.parametrize('async_mode', ['false', 'true'])
+def test_failed_project_cancels_the_projects_still_polling(capsys, fake_openqualitychecker, monkeypatch,
+                                                            async_mode):
+    if async_mode == 'true':
+        pytest.importorskip('aiohttp')
+
+    monkeypatch.setenv('OPENQUALITYCHECKER_PROJECT_NAME', f'{project_name(1)},unknown-project')
+    monkeypatch.setenv('OPENQUALITYCHECKER_WORKERS', '2')
+    monkeypatch.setenv('OPENQUALITYCHECKER_ASYNC', async_mode)
+    monkeypatch.setenv('OPENQUALITYCHECKER_POLL_MIN_INTERVAL', '60')
+    fake_openqualitychecker.analysis_delay = 3600
+
+    started = time.monotonic()
+    result, wrapped_error = run_the_pipe(capsys)
+
+    assert_exit_code(wrapped_error, 1)
+    assert_output(result, '[unknown-project] Project id NOT found for project name')
+    assert time.monotonic() - started < 10
+
+
+@pytest.fixture
+def fake_openqualitychecker(monkeypatch):
+    with FakeOpenQualityChecker(projects=30, branches=2, versions=5, rules=3) as fake:
+        variables = {
+            'OPENQUALITYCHECKER_BASE_URL': fake.base_url,
+            'OPENQUALITYCHECKER_ACCESS_TOKEN': fake.token,
+            'OPENQUALITYCHECKER_PROJECT_NAME': project_name(1),
+            'BITBUCKET_USERNAME': 'dummy_user',
+            'BITBUCKET_PASSWORD': 'dummy_password',
+            'BITBUCKET_REPOSITORY': 'dummy_repository',
+            'BITBUCKET_BRANCH': BRANCH_NAME,
+            'BITBUCKET_COMMIT': COMMIT_HASH
+        }
+
+        for name, value in variables.items():
+            monkeypatch.setenv(name, value)
+
+        yield fake
+
+
+@pytest.fixture
+def bitbucket_repository(monkeypatch):
+    monkeypatch.setenv('BITBUCKET_USERNAME', 'dummy_user')
+    monkeypatch.setenv('BITBUCKET_REPOSITORY', 'dummy_repository')
+    monkeypatch.delenv('BITBUCKET_PASSWORD', raising=False)
+
+
+class FakeBitbucketTransport(BaseAdapter):
+
+    def __init__(self, reports=(), annotations=(), failing_external_id=None, rate_limited_deletes=0, page_size=2):
+        super().__init__()
+        self.reports = list(reports)
+        self.annotations = {annotation['external_id']: dict(annotation) for annotation in annotations}
+        self.failing_external_id = failing_external_id
+        self.rate_limited_deletes = rate_limited_deletes
+        self.page_size = page_size
+        self.uploaded_batches = []
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def count_requests(self, method):
+        return sum(1 for request_method, _ in self.requests if request_method == method)
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        page = int(parse_qs(url.query).get('page', ['1'])[0])
+
+        with self._lock:
+            self.requests.append((request.method, url.path))
+
+            if request.method == 'GET' and url.path.endswith('/reports'):
+                return self._respond(request, 200, self._page(request, self.reports, page))
+
+            if request.method == 'PUT' and '/annotations/' not in url.path:
+                report = dict(json.loads(request.body), uuid='{created-report}')
+                self.reports.append(report)
+
+                return self._respond(request, 200, report)
+
+            if request.method == 'GET':
+                return self._respond(request, 200, self._page(request, list(self.annotations.values()), page))
+
+            if request.method == 'POST':
+                batch = json.loads(request.body)
+
+                if any(annotation['external_id'] == self.failing_external_id for annotation in batch):
+                    return self._respond(request, 500, {'error': 'Internal Server Error'})
+
+                self.uploaded_batches.append(batch)
+                self.annotations.update((annotation['external_id'], annotation) for annotation in batch)
+
+                return self._respond(request, 200, batch)
+
+            if request.method == 'PUT':
+                annotation = json.loads(request.body)
+                self.annotations[annotation['external_id']] = annotation
+
+                return self._respond(request, 200, annotation)
+
+            if self.rate_limited_deletes:
+                self.rate_limited_deletes = self.rate_limited_deletes - 1
+
+                return self._respond(request, 429, {}, {'Retry-After': '0'})
+
+            self.annotations.pop(url.path.rsplit('/', 1)[1])
+
+            return self._respond(request, 204, None)
+
+    def _page(self, request, values, page):
+        body = {'values': values[(page - 1) * self.page_size:page * self.page_size]}
+
+        if page * self.page_size < len(values):
+            body['next'] = f"{request.url.split('?')[0]}?page={page + 1}"
+
+        return body
+
+    def _respond(self, request, status, body, headers=None):
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers or {})
+        response.url = request.url
+        response.request = request
+        response._content = b'' if body is None else json.dumps(body).encode('utf-8')
+        response._content_consumed = True
+
+        return response
+
+    def close(self):
+        pass
+
+
+def create_finding(index):
+    return {'annotation_type': 'CODE_SMELL', 'external_id': f'finding-{index}', 'summary': f'Finding {index}',
+            'details': 'Rule violated', 'severity': 'MEDIUM', 'result': 'FAILED', 'line': index,
+            'path': 'src/Main.java'}
+
+
+@pytest.fixture
+def simulated_clock():
+    system_clock = get_clock()
+    clock = SimulatedClock()
+    set_clock(clock)
+
+    yield clock
+
+    set_clock(system_clock)
+
+
 def run_the_pipe(capsys):
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         pipe = OpenQualityCheckerPipe(schema=parameter_schema)
@@ -0,0 +1,101 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+_current_span = ContextVar('current_span', default=None)
+
+_exporter = None
+
+
+def set_exporter(exporter):
+    global _exporter
+
+    _exporter = exporter
+
+
+def get_current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def start_span(name, **attributes):
+    parent = _current_span.get()
+    span = Span(name, parent, attributes)
+    token = _current_span.set(span)
+
+    try:
+        yield span
+    except BaseException as error:
+        span.set_error(error)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+        if _exporter is not None:
+            _exporter.export(span)
+
+
+class Span:
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.error = None
+        self.start_time = time.time()
+        self.duration = None
+        self._started = time.monotonic()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = f'{type(error).__name__}: {error}'
+
+    def end(self):
+        self.duration = time.monotonic() - self._started
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error
+        }
+
+
+class InMemoryExporter:
+
+    def __init__(self):
+        self.spans = []
+        self._lock = Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class JsonLinesExporter:
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._lock = Lock()
+
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+
+        with self._lock:
+            with open(self._file_name, 'a') as trace_file:
+                trace_file.write(f'{line}\n')
@@ -0,0 +1,171 @@
+import base64
+import gzip
+import json
+import os
+from datetime import timedelta
+from threading import Lock
+
+from requests import ConnectionError, Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from atomic_file import write_file_atomically
+from clock import get_clock
+
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+
+CASSETTE_VERSION = 1
+
+# Response headers kept in a cassette, the body is stored decoded so the
+# transfer headers of the original response do not apply to it any more
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After', 'Location')
+
+_cassette = None
+
+
+def set_cassette(cassette):
+    global _cassette
+
+    _cassette = cassette
+
+
+def get_cassette():
+    return _cassette
+
+
+def create_transport_adapter(**kwargs):
+    if _cassette is None:
+        return None
+
+    if _cassette.mode == MODE_REPLAY:
+        return ReplayAdapter(_cassette)
+
+    return RecordingAdapter(_cassette, **kwargs)
+
+
+class Cassette:
+
+    def __init__(self, file_name, mode=MODE_RECORD, speed=1, clock=None):
+        self.file_name = file_name
+        self.mode = mode
+        self.speed = speed
+        self.clock = clock or get_clock()
+        self._interactions = []
+        self._replay_queues = {}
+        self._started = self.clock.monotonic()
+        self._lock = Lock()
+
+        if mode == MODE_REPLAY:
+            self._load()
+
+    def __len__(self):
+        return len(self._interactions)
+
+    def record(self, request, response, elapsed):
+        interaction = {
+            'offset': round(max(self.clock.monotonic() - self._started - elapsed, 0), 6),
+            'elapsed': round(elapsed, 6),
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers}
+        }
+
+        try:
+            interaction['body'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body_base64'] = base64.b64encode(response.content).decode('ascii')
+
+        with self._lock:
+            self._interactions.append(interaction)
+
+    def next_interaction(self, method, url):
+        with self._lock:
+            queue = self._replay_queues.get((method, url))
+
+            if not queue:
+                raise ConnectionError(f'No recorded response for {method} {url} in {self.file_name}')
+
+            # The last response of a url is served again once the recorded ones
+            # run out, because a replayed run may poll more often than the
+            # recorded one did
+            return queue.pop(0) if len(queue) > 1 else queue[0]
+
+    def get_replay_delay(self, interaction):
+        # A response is answered as many seconds after the start of the
+        # replay as it was during the recording, but never faster than the
+        # recorded request took
+        answer_at = self._started + (interaction['offset'] + interaction['elapsed']) / self.speed
+
+        return max(answer_at - self.clock.monotonic(), interaction['elapsed'] / self.speed)
+
+    def save(self):
+        with self._lock:
+            content = json.dumps({'version': CASSETTE_VERSION, 'interactions': self._interactions},
+                                 separators=(',', ':'))
+
+        write_file_atomically(self.file_name, content, compress=True)
+
+    def _load(self):
+        with gzip.open(self.file_name, 'rt', encoding='utf-8') as cassette_file:
+            content = json.load(cassette_file)
+
+        if content.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version {content.get('version')} in {self.file_name}")
+
+        self._interactions = content['interactions']
+
+        for interaction in self._interactions:
+            self._replay_queues.setdefault((interaction['method'], interaction['url']), []).append(interaction)
+
+
+class RecordingAdapter(HTTPAdapter):
+
+    def __init__(self, cassette, **kwargs):
+        self._cassette: Cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        started = self._cassette.clock.monotonic()
+        response = super().send(request, **kwargs)
+
+        if not kwargs.get('stream'):
+            self._cassette.record(request, response, self._cassette.clock.monotonic() - started)
+
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+
+    def __init__(self, cassette):
+        self._cassette: Cassette = cassette
+        super().__init__()
+
+    def send(self, request, **kwargs):
+        interaction = self._cassette.next_interaction(request.method, request.url)
+
+        if self._cassette.speed:
+            self._cassette.clock.sleep(self._cassette.get_replay_delay(interaction))
+
+        response = Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        response.elapsed = timedelta(seconds=interaction['elapsed'])
+
+        if 'body_base64' in interaction:
+            response._content = base64.b64decode(interaction['body_base64'])
+        else:
+            response._content = interaction['body'].encode('utf-8')
+
+        response._content_consumed = True
+
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,54 @@
+from threading import Lock
+
+
+class VersionTracker:
+
+    def __init__(self):
+        self._seen_versions = {}
+        self._lock = Lock()
+
+    def find_version_id(self, branch_id, versions, commit_hash):
+        versions = versions or []
+
+        with self._lock:
+            seen = self._seen_versions.get((branch_id, commit_hash))
+
+            if seen is not None and seen['version_id'] is not None:
+                return seen['version_id']
+
+            version_id = None
+
+            for version in self._get_new_versions(seen, versions):
+                if version.get('hash') == commit_hash:
+                    version_id = version.get('id')
+                    break
+
+            self._seen_versions[(branch_id, commit_hash)] = {
+                'versions': versions,
+                'count': len(versions),
+                'first_id': versions[0].get('id') if versions else None,
+                'last_id': versions[-1].get('id') if versions else None,
+                'version_id': version_id
+            }
+
+        return version_id
+
+    def _get_new_versions(self, seen, versions):
+        if seen is None or not seen['count']:
+            return versions
+
+        if versions is seen['versions']:
+            return []
+
+        count = seen['count']
+
+        if len(versions) < count:
+            return versions
+
+        if versions[0].get('id') == seen['first_id'] and versions[count - 1].get('id') == seen['last_id']:
+            return versions[count:]
+
+        if versions[-count].get('id') == seen['first_id'] and versions[-1].get('id') == seen['last_id']:
+            return versions[:len(versions) - count]
+
+        return versions
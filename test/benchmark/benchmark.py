@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import gc
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+
+sys.path.insert(0, os.path.join(ROOT_DIR, 'pipe'))
+
+from bitbucket_pipes_toolkit import Pipe  # noqa: E402
+
+import openqualitychecker_api  # noqa: E402
+from fake_openqualitychecker import BRANCH_NAME, COMMIT_HASH, FakeOpenQualityCheckerProcess, project_name  # noqa: E402
+from metrics import MetricsRecorder, set_metrics_recorder  # noqa: E402
+from openqualitychecker_service import OpenQualityCheckerService  # noqa: E402
+from pipe import parameter_schema  # noqa: E402
+
+DEFAULT_OUTPUT_FILE = os.path.join(BENCHMARK_DIR, 'benchmark-results.json')
+
+# Every scenario overrides some of these settings
+DEFAULT_SCENARIO = {
+    'projects': 1000,
+    'branches': 3,
+    'versions': 50,
+    'rules': 20,
+    'analysis_delay': 0,
+    'latency': 'lan',
+    'page_size': openqualitychecker_api.PROJECT_PAGE_SIZE,
+    'project_names': 1,
+    'workers': 1,
+    'async_mode': False,
+}
+
+SCENARIOS = [
+    *[{'name': f'projects-{projects}', 'projects': projects} for projects in (100, 1000, 5000)],
+    *[{'name': f'page-size-{page_size}', 'projects': 2000, 'page_size': page_size} for page_size in (20, 100, 500)],
+    *[{'name': f'project-names-{project_names}', 'project_names': project_names} for project_names in (1, 5, 20)],
+    {'name': 'project-names-20-workers-5', 'project_names': 20, 'workers': 5},
+    {'name': 'project-names-20-async-5', 'project_names': 20, 'workers': 5, 'async_mode': True},
+    {'name': 'analysis-delay-2s', 'project_names': 5, 'analysis_delay': 2},
+    {'name': 'versions-5000', 'project_names': 5, 'versions': 5000},
+    {'name': 'rules-2000', 'project_names': 5, 'rules': 2000},
+    {'name': 'latency-wan', 'project_names': 5, 'latency': 'wan'},
+    {'name': 'large-listings', 'projects': 5000, 'branches': 50, 'versions': 5000, 'project_names': 5},
+]
+
+
+def create_pipe(fake, scenario):
+    os.environ.update({
+        'BITBUCKET_USERNAME': 'benchmark-user',
+        'BITBUCKET_REPOSITORY': 'benchmark-repository',
+        'BITBUCKET_BRANCH': BRANCH_NAME,
+        'BITBUCKET_COMMIT': COMMIT_HASH,
+        'OPENQUALITYCHECKER_BASE_URL': fake.base_url,
+        'OPENQUALITYCHECKER_ACCESS_TOKEN': fake.token,
+        'OPENQUALITYCHECKER_PROJECT_NAME': ', '.join(select_project_names(scenario)),
+        'OPENQUALITYCHECKER_WORKERS': f"{scenario['workers']}",
+        'OPENQUALITYCHECKER_RATE_LIMIT': '0',
+        'OPENQUALITYCHECKER_POLL_MIN_INTERVAL': '0.1',
+        'OPENQUALITYCHECKER_POLL_MAX_INTERVAL': '1',
+    })
+
+    pipe = Pipe(schema=parameter_schema)
+    pipe.logger.setLevel(logging.WARNING)
+
+    return pipe
+
+
+def select_project_names(scenario):
+    project_count = min(scenario['project_names'], scenario['projects'])
+    step = scenario['projects'] / project_count
+
+    return [project_name(int(step * (index + 1))) for index in range(project_count)]
+
+
+def evaluate_projects(pipe, scenario, oqc_project_names):
+    if scenario['async_mode']:
+        return asyncio.run(evaluate_projects_async(pipe, scenario, oqc_project_names))
+
+    service = OpenQualityCheckerService(pipe)
+
+    try:
+        service.check_availability()
+
+        if scenario['workers'] <= 1:
+            return [service.get_quality_result(name, BRANCH_NAME, COMMIT_HASH) for name in oqc_project_names]
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=scenario['workers']) as executor:
+            return list(executor.map(lambda name: service.get_quality_result(name, BRANCH_NAME, COMMIT_HASH),
+                                     oqc_project_names))
+    finally:
+        service.close()
+
+
+async def evaluate_projects_async(pipe, scenario, oqc_project_names):
+    # aiohttp is optional, the sync scenarios run without it
+    from openqualitychecker_async_service import AsyncOpenQualityCheckerService
+
+    service = AsyncOpenQualityCheckerService(pipe, scenario['workers'])
+    semaphore = asyncio.Semaphore(scenario['workers'])
+
+    async def get_quality_result(name):
+        async with semaphore:
+            return await service.get_quality_result(name, BRANCH_NAME, COMMIT_HASH)
+
+    try:
+        await service.check_availability()
+
+        return await asyncio.gather(*[get_quality_result(name) for name in oqc_project_names])
+    finally:
+        await service.close()
+
+
+def run_scenario(scenario):
+    scenario = {**DEFAULT_SCENARIO, **scenario}
+    # Every scenario creates its own service, and with it its own rate
+    # limiters and circuit breaker, only the run metrics are shared
+    metrics = MetricsRecorder()
+    set_metrics_recorder(metrics)
+    openqualitychecker_api.PROJECT_PAGE_SIZE = scenario['page_size']
+
+    # The fake server runs in another process, so that its allocations do not
+    # count towards the peak memory of the pipe
+    with FakeOpenQualityCheckerProcess(projects=scenario['projects'],
+                                       branches=scenario['branches'],
+                                       versions=scenario['versions'],
+                                       rules=scenario['rules'],
+                                       analysis_delay=scenario['analysis_delay'],
+                                       latency=scenario['latency']) as fake:
+        pipe = create_pipe(fake, scenario)
+        oqc_project_names = select_project_names(scenario)
+
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+
+        try:
+            quality_profiles = evaluate_projects(pipe, scenario, oqc_project_names)
+            error = None
+        except Exception as exception:
+            quality_profiles = []
+            error = f'{type(exception).__name__}: {exception}'
+
+        duration = time.perf_counter() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        openqualitychecker_api.PROJECT_PAGE_SIZE = DEFAULT_SCENARIO['page_size']
+
+        stats = fake.get_stats()
+        metrics_summary = metrics.get_summary()
+
+        return {
+            'scenario': scenario,
+            'duration': duration,
+            'duration_per_project': duration / len(oqc_project_names),
+            'requests': sum(stats['requests'].values()),
+            'requests_by_endpoint': stats['requests'],
+            'bytes_sent': stats['bytes_sent'],
+            'bytes_received_by_endpoint': {request['endpoint']: request['bytes']
+                                           for request in metrics_summary['requests']},
+            'decode_time': sum(decoding['total'] for decoding in metrics_summary['decoding']),
+            'decode_time_by_endpoint': {decoding['endpoint']: decoding['total']
+                                        for decoding in metrics_summary['decoding']},
+            'peak_memory': peak_memory,
+            'quality_profiles': sum(1 for quality_profile in quality_profiles if quality_profile),
+            'error': error
+        }
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the OpenQualityChecker pipe against a fake server in a child process')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_FILE, help='JSON file the results are written to')
+    parser.add_argument('--scenario', action='append', default=[],
+                        help='Runs only the scenarios whose name contains this text, can be repeated')
+    parser.add_argument('--latency', help='Overrides the latency profile of every scenario: none, lan or wan')
+    arguments = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not arguments.scenario or any(name in scenario['name'] for name in arguments.scenario)]
+
+    results = []
+
+    for scenario in scenarios:
+        if arguments.latency:
+            scenario = {**scenario, 'latency': arguments.latency}
+
+        if scenario.get('async_mode') and importlib.util.find_spec('aiohttp') is None:
+            print(f"{scenario['name']:<32} skipped, the aiohttp package is not installed")
+            continue
+
+        result = run_scenario(scenario)
+        results.append(result)
+
+        print(f"{scenario['name']:<32} {result['duration']:8.3f} s {result['requests']:6d} requests "
+              f"{result['bytes_sent'] / 1024:10.1f} KiB sent {result['decode_time'] * 1000:8.1f} ms decoding "
+              f"{result['peak_memory'] / 1024:10.1f} KiB peak"
+              f"{'  ' + result['error'] if result['error'] else ''}")
+
+    with open(arguments.output, 'w') as output_file:
+        json.dump({
+            'created': datetime.now(timezone.utc).isoformat(),
+            'revision': get_git_revision(),
+            'python': platform.python_version(),
+            'results': results
+        }, output_file, indent=2)
+
+    print(f'Results written to {arguments.output}')
+
+
+if __name__ == '__main__':
+    main()
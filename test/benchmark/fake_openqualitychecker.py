@@ -0,0 +1,325 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+BASE_PATH = '/backend'
+
+# Answers the request counts of a fake server running in another process,
+# it is not counted itself
+STATS_PATH = '/benchmark/stats'
+
+COMMIT_HASH = 'benchmark-commit-hash'
+
+BRANCH_NAME = 'master'
+
+# Responses smaller than this are sent uncompressed even if the client
+# accepts gzip
+MIN_COMPRESSED_SIZE = 1024
+
+# Seconds added to every request, as (fixed, random spread)
+LATENCY_PROFILES = {
+    'none': (0, 0),
+    'lan': (0.002, 0.001),
+    'wan': (0.05, 0.02),
+}
+
+_BRANCHES_PATH = re.compile(r'/api/project/(\d+)/branches$')
+_VERSIONS_PATH = re.compile(r'/api/branch/(\d+)/versions$')
+_QUALITY_PROFILE_PATH = re.compile(r'/api/version/(\d+)/qualityProfile$')
+
+
+def project_name(project_id):
+    return f'benchmark-project-{project_id}'
+
+
+class FakeOpenQualityChecker:
+
+    def __init__(self, projects=100, branches=3, versions=50, rules=20, analysis_delay=0, latency='none',
+                 token='benchmark-token', rate_limited_requests=0):
+        self.projects = projects
+        self.branches = branches
+        self.versions = versions
+        self.rules = rules
+        self.analysis_delay = analysis_delay
+        self.latency = LATENCY_PROFILES[latency]
+        self.token = token
+        self.rate_limited_requests = rate_limited_requests
+        self.requests = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._started = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}{BASE_PATH}'
+
+    @property
+    def request_count(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def start(self):
+        fake = self
+
+        class Handler(FakeOpenQualityCheckerHandler):
+            server_fake = fake
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._started = time.monotonic()
+
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count_request(self, endpoint, size):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent += size
+
+    def take_rate_limited_request(self):
+        with self._lock:
+            if not self.rate_limited_requests:
+                return False
+
+            self.rate_limited_requests = self.rate_limited_requests - 1
+
+            return True
+
+    def is_analysis_finished(self):
+        return time.monotonic() - self._started >= self.analysis_delay
+
+    def get_projects_page(self, page, size):
+        first_project_id = (page - 1) * size + 1
+        last_project_id = min(page * size, self.projects)
+        total_pages = max((self.projects + size - 1) // size, 1)
+
+        return {
+            'content': [{'id': project_id,
+                         'projectName': project_name(project_id),
+                         'description': f'Generated project {project_id}',
+                         'url': f'https://example.com/benchmark/{project_id}.git',
+                         'privateProject': True}
+                        for project_id in range(first_project_id, last_project_id + 1)],
+            'number': page - 1,
+            'size': size,
+            'totalPages': total_pages,
+            'totalElements': self.projects,
+            'last': page >= total_pages
+        }
+
+    def get_branches(self, project_id):
+        branch_names = [BRANCH_NAME] + [f'feature-{index}' for index in range(1, self.branches)]
+
+        return [{'id': project_id * 1000 + index, 'branchName': branch_name}
+                for index, branch_name in enumerate(branch_names)]
+
+    def get_versions(self, branch_id):
+        versions = [{'id': branch_id * 1000 + index,
+                     'hash': f'{branch_id:08x}{index:032x}',
+                     'committerName': 'Benchmark Committer',
+                     'committerDate': '2021-01-01T00:00:00Z',
+                     'log': f'Generated commit {index}'}
+                    for index in range(1, self.versions + 1)]
+
+        if self.is_analysis_finished():
+            versions.append({'id': branch_id * 1000, 'hash': COMMIT_HASH,
+                             'committerName': 'Benchmark Committer',
+                             'committerDate': '2021-01-02T00:00:00Z',
+                             'log': 'Benchmarked commit'})
+
+        return versions
+
+    def get_quality_profile(self, version_id):
+        if not self.is_analysis_finished():
+            return None
+
+        return {
+            'result': version_id % 2 == 0,
+            'resultsOfRules': [{'type': 'WARNING',
+                                'entity': f'benchmark:rule-{index}',
+                                'operator': 'LE',
+                                'value': 10.0,
+                                'actualValue': index * 0.5,
+                                'result': index * 0.5 <= 10.0}
+                               for index in range(self.rules)]
+        }
+
+
+class FakeOpenQualityCheckerProcess:
+
+    def __init__(self, token='benchmark-token', **settings):
+        self.token = token
+        self._settings = {**settings, 'token': token}
+        self._process = None
+        self.base_url = None
+
+    def get_stats(self):
+        with urlopen(f'{self.base_url[:-len(BASE_PATH)]}{STATS_PATH}') as response:
+            return json.load(response)
+
+    def start(self):
+        arguments = [sys.executable, os.path.abspath(__file__)]
+
+        for name, value in self._settings.items():
+            arguments.extend([f"--{name.replace('_', '-')}", f'{value}'])
+
+        self._process = subprocess.Popen(arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         universal_newlines=True)
+        self.base_url = self._process.stdout.readline().strip()
+
+        return self
+
+    def stop(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeOpenQualityCheckerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_fake: FakeOpenQualityChecker = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server_fake
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path[len(BASE_PATH):] if url.path.startswith(BASE_PATH) else url.path
+
+        if url.path == STATS_PATH:
+            with fake._lock:
+                stats = {'requests': dict(fake.requests), 'bytes_sent': fake.bytes_sent}
+
+            content = json.dumps(stats).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+
+        fixed_latency, latency_spread = fake.latency
+
+        if fixed_latency or latency_spread:
+            time.sleep(fixed_latency + random.uniform(0, latency_spread))
+
+        if fake.take_rate_limited_request():
+            return self._send('rate_limited', 429, {'error': 'Too Many Requests'}, headers={'Retry-After': '0'})
+
+        if self.headers.get('token') != fake.token:
+            return self._send('other', 403, {'error': 'Forbidden'})
+
+        if path == '/api/projects':
+            page = int(query.get('page', ['1'])[0])
+            size = int(query.get('size', ['20'])[0])
+
+            return self._send('projects', 200, {'data': fake.get_projects_page(page, size)})
+
+        match = _BRANCHES_PATH.match(path)
+
+        if match and 0 < int(match.group(1)) <= fake.projects:
+            return self._send('branches', 200, {'data': fake.get_branches(int(match.group(1)))})
+
+        match = _VERSIONS_PATH.match(path)
+
+        if match:
+            return self._send('versions', 200, {'data': fake.get_versions(int(match.group(1)))}, conditional=True)
+
+        match = _QUALITY_PROFILE_PATH.match(path)
+
+        if match:
+            quality_profile = fake.get_quality_profile(int(match.group(1)))
+
+            if quality_profile is None:
+                return self._send('quality_profile', 200, {'error': 'Data not found'})
+
+            return self._send('quality_profile', 200, {'data': quality_profile}, conditional=True)
+
+        return self._send('other', 404 if path else 200, {})
+
+    def _send(self, endpoint, status, body, conditional=False, headers=None):
+        content = json.dumps(body).encode('utf-8')
+        etag = f'"{zlib.crc32(content):08x}"'
+
+        if conditional and self.headers.get('If-None-Match') == etag:
+            self.server_fake.count_request(endpoint, 0)
+
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+
+        if conditional:
+            headers['ETag'] = etag
+
+        if len(content) >= MIN_COMPRESSED_SIZE and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.server_fake.count_request(endpoint, len(content))
+
+        self.send_response(status)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a fake OpenQualityChecker API until stdin is closed')
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--branches', type=int, default=3)
+    parser.add_argument('--versions', type=int, default=50)
+    parser.add_argument('--rules', type=int, default=20)
+    parser.add_argument('--analysis-delay', type=float, default=0)
+    parser.add_argument('--latency', default='none', choices=sorted(LATENCY_PROFILES))
+    parser.add_argument('--token', default='benchmark-token')
+    arguments = parser.parse_args()
+
+    with FakeOpenQualityChecker(**vars(arguments)) as fake:
+        print(fake.base_url, flush=True)
+
+        sys.stdin.read()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPE_DIR = os.path.join(os.path.dirname(os.path.dirname(BENCHMARK_DIR)), 'pipe')
+
+# The median time in seconds importing the pipe entry point may take, a run
+# over it fails so that a heavy import on the start-up path is noticed
+IMPORT_TIME_BUDGET = 0.15
+
+# Modules that only some runs need and that are imported when they are used
+DEFERRED_MODULES = ('aiohttp', 'asyncio', 'http.server', 'openqualitychecker_async_service')
+
+IMPORT_TIME_PREFIX = 'import time:'
+
+STARTUP_SCRIPT = f'import json, pipe, sys; print(json.dumps([m for m in {DEFERRED_MODULES!r} if m in sys.modules]))'
+
+
+def measure_import(python):
+    started = time.perf_counter()
+    result = subprocess.run([python, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+                            cwd=PIPE_DIR, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    process_time = time.perf_counter() - started
+
+    modules = {}
+
+    for line in result.stderr.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX) or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len(IMPORT_TIME_PREFIX):].split('|')
+        modules[name.strip()] = int(cumulative) / 1e6
+
+    return process_time, modules, json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how long starting the pipe takes before any work begins')
+    parser.add_argument('--runs', type=int, default=10, help='How many interpreters are started')
+    parser.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET,
+                        help='Median import time of the pipe entry point in seconds that fails the run')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--python', default=sys.executable, help='The interpreter to measure')
+    arguments = parser.parse_args()
+
+    measurements = [measure_import(arguments.python) for _ in range(arguments.runs)]
+
+    process_time = statistics.median(process_time for process_time, _, _ in measurements)
+    import_time = statistics.median(modules['pipe'] for _, modules, _ in measurements)
+    _, modules, loaded_deferred_modules = measurements[-1]
+    slowest_modules = sorted(((name, seconds) for name, seconds in modules.items()
+                              if '.' not in name), key=lambda module: -module[1])[:10]
+
+    print(f'Interpreter start-up and import: {process_time * 1000:7.1f} ms (median of {arguments.runs})')
+    print(f'Import of the pipe entry point:  {import_time * 1000:7.1f} ms (budget {arguments.budget * 1000:.0f} ms)')
+
+    for name, seconds in slowest_modules:
+        print(f'    {name:<40} {seconds * 1000:7.1f} ms')
+
+    if loaded_deferred_modules:
+        print(f"Imported at start-up although deferred: {', '.join(loaded_deferred_modules)}")
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump({
+                'python': platform.python_version(),
+                'runs': arguments.runs,
+                'process_time': process_time,
+                'import_time': import_time,
+                'budget': arguments.budget,
+                'slowest_modules': dict(slowest_modules),
+                'loaded_deferred_modules': loaded_deferred_modules
+            }, output_file, indent=2)
+
+    if import_time > arguments.budget or loaded_deferred_modules:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()